@@ -3,20 +3,27 @@
 import logging
 import os
 from datetime import timedelta
-from logging.handlers import RotatingFileHandler, SMTPHandler
+from logging.handlers import RotatingFileHandler
 
 import click
-from flask import Flask, render_template, request, session
+from flask import Flask, render_template, session
 from flask_babel import _
 from flask_wtf.csrf import CSRFError
 
+from recordit.audit import audit
 from recordit.blueprints.auth import auth_bp
 from recordit.blueprints.admin import admin_bp
 from recordit.blueprints.user import user_bp
 from recordit.blueprints.front import front_bp
 from recordit.extensions import (babel, bootstrap, cache, ckeditor, csrf, db,
                                  login_manager, scheduler, toolbar, moment)
+from recordit.loggers import (BackgroundHandler, RequestFormatter,
+                              ThrottledSMTPHandler)
+from recordit.metrics import metrics
+from recordit.profiler import profiler
 from recordit.settings import basedir, config
+from recordit.sqlstats import sqlstats
+from recordit.traces import traces
 
 
 def create_app(config_name=None):
@@ -40,13 +47,6 @@ def create_app(config_name=None):
 
 
 def register_logging(app):
-    class RequestFormatter(logging.Formatter):
-
-        def format(self, record):
-            record.url = request.url
-            record.remote_addr = request.remote_addr
-            return super(RequestFormatter, self).format(record)
-
     formatter = RequestFormatter(
         '[%(asctime)s] - %(name)s - %(remote_addr)s requested %(url)s\n'
         '%(levelname)s in %(module)s: %(message)s'
@@ -59,19 +59,20 @@ def register_logging(app):
     file_handler.setFormatter(formatter)
     file_handler.setLevel(logging.INFO)
 
-    mail_handler = SMTPHandler(
+    mail_handler = ThrottledSMTPHandler(
         mailhost=app.config['MAIL_SERVER'],
         fromaddr=app.config['MAIL_USERNAME'],
         toaddrs=app.config['ADMIN_EMAIL'],
         subject='recordit Application Error',
-        credentials=('apikey', app.config['MAIL_PASSWORD']))
+        credentials=('apikey', app.config['MAIL_PASSWORD']),
+        window=app.config['ERROR_MAIL_WINDOW'],
+        limit=app.config['ERROR_MAIL_LIMIT'])
 
     mail_handler.setLevel(logging.ERROR)
     mail_handler.setFormatter(formatter)
 
     if not app.debug:
-        app.logger.addHandler(mail_handler)
-        app.logger.addHandler(file_handler)
+        app.logger.addHandler(BackgroundHandler(mail_handler, file_handler))
 
 
 def register_extensions(app):
@@ -84,9 +85,17 @@ def register_extensions(app):
     ckeditor.init_app(app)
     moment.init_app(app)
     toolbar.init_app(app)
+    audit.init_app(app)
+    sqlstats.init_app(app)
+    profiler.init_app(app)
+    traces.init_app(app)
     scheduler.init_app(app)
     scheduler.start()
 
+    # imported for its side effect: the @scheduler.task decorators of the
+    # module register the scheduled jobs
+    import recordit.timer  # noqa: F401
+
 
 def register_blueprints(app):
     app.register_blueprint(front_bp)
@@ -175,16 +184,14 @@ def register_commands(app):
         click.echo('Done.')
 
     @app.cli.command()
-    @click.option('--teacher', default=3, help='Quantity of teachers, default is 3.')
-    @click.option('--student', default=20, help='Quantity of students, default is 20.')
-    @click.option('--course', default=3, help='Quantity of courses, default is 3.')
-    @click.option('--report', default=5, help='Quantity of reports, default is 5.')
-    @click.option('--record', default=30, help='Quantity of records, default is 30.')
-    def forge(teacher, student, course, report, record):
+    @click.option('--scale', default=1.0, help='Size of the data set, default is 1 (about 200 students).')
+    @click.option('--seed', default=0, help='Random seed, default is 0.')
+    @click.option('--year', type=int, help='Year of the fake term, default is fixed at 2019.')
+    def forge(scale, seed, year):
         """Generate fake data."""
 
         from recordit.models import Role
-        from recordit.fakes import fake_admin, fake_teacher, fake_student, fake_course, fake_report, fake_record
+        from recordit.fakes import YEAR, fake_admin, forge
 
         db.drop_all()
         db.create_all()
@@ -195,26 +202,59 @@ def register_commands(app):
         click.echo('Generating the administrator...')
         fake_admin()
 
-        click.echo('Generating %d teachers...' % teacher)
-        fake_teacher(teacher)
+        counts = forge(scale, seed, year or YEAR, echo=click.echo)
+
+        click.echo('Done: %(teachers)d teachers, %(students)d students, %(courses)d courses, '
+                   '%(reports)d reports, %(records)d records.' % counts)
+
+    @app.cli.command()
+    def upgrade():
+        """Upgrade the database of an older release in place."""
+
+        from recordit.models import Report, Role
+        from recordit.upgrade import upgrade_schema
+
+        click.echo('Upgrading the tables...')
+        added = upgrade_schema(echo=click.echo)
+
+        click.echo('Initializing the roles and permissions...')
+        Role.init_role()
 
-        click.echo('Generating %d students...' % student)
-        fake_student(student, grade='2017')
+        click.echo('Rebuilding report scores...')
+        Report.refresh_score()
 
-        click.echo('Generating %d students...' % student)
-        fake_student(student, grade='2016')
+        click.echo('Done, %d columns added.' % len(added))
 
-        click.echo('Generating %d courses...' % course)
-        fake_course(course)
+    @app.cli.command()
+    @click.option('--report', type=int, help='Only rebuild this report.')
+    def rescore(report):
+        """Rebuild report score aggregates from record tables."""
 
-        click.echo('Generating %d reports...' % report)
-        fake_report(report)
+        from recordit.models import Report
 
-        click.echo('Generating %d records...' % record)
-        fake_record(record)
+        click.echo('Rebuilding report scores...')
+        Report.refresh_score(report)
 
         click.echo('Done.')
 
+    @app.cli.command()
+    @click.option('--days', type=int, help='Archive logs older than this, default is LOG_RETENTION_DAYS.')
+    def archive(days):
+        """Move old user logs into the compressed monthly archive."""
+
+        import datetime
+
+        from recordit.audit import archive_logs
+
+        before = None
+        if days is not None:
+            before = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+
+        click.echo('Archiving user logs...')
+        count = archive_logs(before)
+
+        click.echo('Archived %d logs.' % count)
+
     @app.cli.group()
     def translate():
         """Translation and localization commands."""
@@ -254,3 +294,5 @@ def register_hook(app):
         session.permanent = True
         app.permanent_session_lifetime = timedelta(
             minutes=app.config['SESSION_LIFETIME_MINUTES'])
+
+    metrics.init_app(app)
@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+
+import atexit
+import datetime
+import gzip
+import json
+import os
+import threading
+from collections import defaultdict
+
+try:
+    from queue import Empty, Queue
+except ImportError:
+    from Queue import Empty, Queue
+
+from flask import current_app
+
+from recordit.extensions import db
+
+
+class Event(object):
+    """Codes of the audited user actions, stored in ``Log.event``.
+
+    The parameters of an event are stored next to it as compact JSON and
+    only turned into text with the event's template when logs are read.
+    Codes are persisted, never renumber them.
+    """
+
+    LOGIN = 1
+    LOGOUT = 2
+
+    REVIEW = 10
+    EDIT_OWN_PROFILE = 11
+    CHANGE_OWN_PASSWORD = 12
+
+    ADMIN_INDEX = 20
+    MANAGE_USER = 21
+    DELETE_USER = 22
+    EDIT_PROFILE = 23
+    CHANGE_PASSWORD = 24
+    REGISTER_USER = 25
+    REGISTER_BATCH = 26
+
+    MANAGE_COURSE = 30
+    SWITCH_COURSE_STATE = 31
+    ADD_COURSE = 32
+
+    MANAGE_REPORT = 40
+    DOWNLOAD_REPORT = 41
+    SWITCH_REPORT_STATE = 42
+    ADD_REPORT = 43
+    DELETE_REPORT = 44
+    ADD_REPORT_BATCH = 45
+
+    MANAGE_RECORD = 50
+    DOWNLOAD_FILE = 51
+    DOWNLOAD_RECORD = 52
+    DELETE_RECORD = 53
+
+    SYSTEM_LOG = 60
+    USER_LOG = 61
+
+    templates = {
+        LOGIN: 'logs/auth/login.html',
+        LOGOUT: 'logs/auth/logout.html',
+        REVIEW: 'logs/user/reivew.html',
+        EDIT_OWN_PROFILE: 'logs/user/settings/edit_profile.html',
+        CHANGE_OWN_PASSWORD: 'logs/user/settings/change_password.html',
+        ADMIN_INDEX: 'logs/admin/index.html',
+        MANAGE_USER: 'logs/admin/manage_user.html',
+        DELETE_USER: 'logs/admin/delete_user.html',
+        EDIT_PROFILE: 'logs/admin/edit_profile.html',
+        CHANGE_PASSWORD: 'logs/admin/change_password.html',
+        REGISTER_USER: 'logs/admin/register_user.html',
+        REGISTER_BATCH: 'logs/admin/register_batch.html',
+        MANAGE_COURSE: 'logs/admin/manage_course.html',
+        SWITCH_COURSE_STATE: 'logs/admin/switch_course_state.html',
+        ADD_COURSE: 'logs/admin/add_course.html',
+        MANAGE_REPORT: 'logs/admin/manage_report.html',
+        DOWNLOAD_REPORT: 'logs/admin/download_report.html',
+        SWITCH_REPORT_STATE: 'logs/admin/switch_report_state.html',
+        ADD_REPORT: 'logs/admin/add_report.html',
+        DELETE_REPORT: 'logs/admin/delete_report.html',
+        ADD_REPORT_BATCH: 'logs/admin/add_report_batch.html',
+        MANAGE_RECORD: 'logs/admin/manage_record.html',
+        DOWNLOAD_FILE: 'logs/admin/download_file.html',
+        DOWNLOAD_RECORD: 'logs/admin/download_record.html',
+        DELETE_RECORD: 'logs/admin/delete_record.html',
+        SYSTEM_LOG: 'logs/admin/system_log.html',
+        USER_LOG: 'logs/admin/user_log.html',
+    }
+
+    @staticmethod
+    def dumps(params):
+        if not params:
+            return None
+        return json.dumps(params, ensure_ascii=False, separators=(',', ':'), default=str)
+
+    @staticmethod
+    def render(event, params=None, content=None):
+        """Text of a log row; rows written before events existed keep ``content``."""
+        if event is None:
+            return content
+
+        template = current_app.jinja_env.get_template(Event.templates[event])
+        return template.render(**json.loads(params or '{}')).strip()
+
+
+class AuditWriter(object):
+    """Buffer ``Log`` rows in memory and insert them in batches.
+
+    Rows are queued by ``write`` and flushed by a background thread every
+    ``AUDIT_FLUSH_INTERVAL`` seconds, or as soon as ``AUDIT_FLUSH_SIZE``
+    rows are waiting, in a single transaction. Anything still queued is
+    flushed when the process exits. With ``AUDIT_BUFFERED`` off every row
+    is inserted right away.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.queue = Queue()
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('AUDIT_BUFFERED', True)
+        app.config.setdefault('AUDIT_FLUSH_INTERVAL', 2.0)
+        app.config.setdefault('AUDIT_FLUSH_SIZE', 200)
+
+        self.app = app
+        app.extensions['audit'] = self
+        atexit.register(self.flush)
+
+    def write(self, **row):
+        row.setdefault('time', datetime.datetime.utcnow())
+        if not self.app.config['AUDIT_BUFFERED']:
+            self.insert([row])
+            return
+
+        self.start()
+        self.queue.put(row)
+        if self.queue.qsize() >= self.app.config['AUDIT_FLUSH_SIZE']:
+            self.wakeup.set()
+
+    def start(self):
+        # uwsgi forks after the app is created, so each worker starts its own thread
+        if self.pid == os.getpid() and self.thread is not None and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.pid != os.getpid() or self.thread is None or not self.thread.is_alive():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(
+                    target=self.run, name='audit-writer')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.app.config['AUDIT_FLUSH_INTERVAL'])
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('Failed to flush audit logs.')
+
+    def flush(self):
+        rows = []
+        while True:
+            try:
+                rows.append(self.queue.get_nowait())
+            except Empty:
+                break
+
+        if rows:
+            self.insert(rows)
+
+    def insert(self, rows):
+        from recordit.models import Log
+
+        with self.app.app_context():
+            with db.engine.begin() as connection:
+                connection.execute(Log.__table__.insert(), rows)
+
+
+audit = AuditWriter()
+
+
+def archive_file(month):
+    return os.path.join(
+        current_app.config['LOG_ARCHIVE_PATH'], 'logs-%s.jsonl.gz' % month)
+
+
+def archive_logs(before=None, size=5000):
+    """Move ``Log`` rows older than ``before`` into per-month archives.
+
+    ``before`` defaults to ``LOG_RETENTION_DAYS`` ago. Rows are appended to
+    ``logs-YYYY-MM.jsonl.gz`` as one JSON object per line, with the user's
+    number and role copied in so the archive stands on its own, and each
+    batch is deleted from the table once its archive write is synced to
+    disk. Every worker process schedules this job, so it holds an exclusive
+    lock on the archive directory and returns at once when another process
+    is already archiving. Returns the number of archived rows.
+    """
+    import fcntl
+
+    if before is None:
+        before = datetime.datetime.utcnow() - datetime.timedelta(
+            days=current_app.config['LOG_RETENTION_DAYS'])
+
+    archive_path = current_app.config['LOG_ARCHIVE_PATH']
+    os.makedirs(archive_path, exist_ok=True)
+
+    with open(os.path.join(archive_path, '.lock'), 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            return 0
+        try:
+            return archive_batches(before, size)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def archive_batches(before, size):
+    """The work of ``archive_logs``, run while holding its lock."""
+    from recordit.models import Log, Role, User
+
+    query = db.session.query(
+        Log.id, Log.user_id, Log.ip, Log.time, Log.event, Log.params,
+        Log.content, User.number, Role.name
+    ).select_from(Log).outerjoin(User, Log.user_id == User.id).outerjoin(
+        Role, User.role_id == Role.id).filter(Log.time < before)
+
+    total = 0
+    while True:
+        rows = query.order_by(Log.id).limit(size).all()
+        if not rows:
+            break
+
+        months = defaultdict(list)
+        for row in rows:
+            months[row.time.strftime('%Y-%m')].append(json.dumps({
+                'id': row.id, 'user_id': row.user_id, 'number': row.number,
+                'role': row.name, 'ip': row.ip, 'time': row.time.isoformat(),
+                'event': row.event, 'params': row.params, 'content': row.content
+            }, ensure_ascii=False, separators=(',', ':')))
+
+        for month, lines in months.items():
+            with open(archive_file(month), 'ab') as f:
+                with gzip.GzipFile(fileobj=f, mode='wb') as z:
+                    z.write(('\n'.join(lines) + '\n').encode('utf-8'))
+                f.flush()
+                os.fsync(f.fileno())
+
+        db.session.query(Log).filter(
+            Log.id.in_([row.id for row in rows])).delete(synchronize_session=False)
+        db.session.commit()
+        total += len(rows)
+
+    return total
+
+
+def archived_months():
+    """Months with archived logs, oldest first, as ``'YYYY-MM'`` strings."""
+    archive_path = current_app.config['LOG_ARCHIVE_PATH']
+    if not os.path.isdir(archive_path):
+        return []
+
+    return sorted(name[len('logs-'):-len('.jsonl.gz')]
+                  for name in os.listdir(archive_path)
+                  if name.startswith('logs-') and name.endswith('.jsonl.gz'))
+
+
+def read_archive(month, start=None, end=None, number=None, role=None, event=None):
+    """Iterate the archived rows of ``month`` matching the ``log_query`` filters."""
+    file = archive_file(month)
+    if not os.path.isfile(file):
+        return
+
+    with gzip.open(file, 'rb') as f:
+        for line in f:
+            row = json.loads(line.decode('utf-8'))
+            row['time'] = datetime.datetime.strptime(
+                row['time'].split('.')[0], '%Y-%m-%dT%H:%M:%S')
+            if start is not None and row['time'] < start:
+                continue
+            if end is not None and row['time'] >= end:
+                continue
+            if number is not None and row['number'] != number:
+                continue
+            if role is not None and row['role'] != role:
+                continue
+            if event is not None and row['event'] != event:
+                continue
+            yield row
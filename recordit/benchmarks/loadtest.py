@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""End-to-end HTTP load test.
+
+Run with ``python -m recordit.benchmarks.loadtest``. The app is created
+with ``create_app``, pointed at its own SQLite database filled by the fake
+data generator, and served by a threaded local server; ``--url`` targets
+an already running server on the same database instead. Virtual users then
+start together and run their role's scenario until ``--duration`` is up:
+
+- students open ``user.index`` and review the same report, like a whole
+  grade at the end of a presentation;
+- teachers page through ``admin.manage_report`` and ``admin.manage_record``
+  of their course;
+- administrators download the report export and the user logs.
+
+Throughput, error rate and p50/p95/p99 latency are reported per endpoint
+and written to ``--output`` (see ``recordit.benchmarks.results``).
+"""
+
+import random
+import re
+import threading
+import time
+from http.cookiejar import CookieJar
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode, urlparse
+from urllib.request import HTTPCookieProcessor, HTTPRedirectHandler, build_opener
+
+import click
+
+from recordit.benchmarks.results import echo_results, summarize, write_results
+
+CSRF_TOKEN = re.compile(r'<input[^>]*name="csrf_token"[^>]*value="([^"]*)"')
+
+
+class NoRedirect(HTTPRedirectHandler):
+    """Time each response on its own instead of following redirects."""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class Stats(object):
+    """Latencies and errors per endpoint, shared by the virtual users."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def add(self, name, elapsed, error):
+        with self.lock:
+            self.latencies.setdefault(name, []).append(elapsed)
+            self.errors[name] = self.errors.get(name, 0) + int(error)
+
+    def summary(self, duration):
+        with self.lock:
+            return dict((name, summarize(latencies, self.errors[name], duration))
+                        for name, latencies in self.latencies.items())
+
+
+class Client(object):
+    """One virtual user with its own cookies."""
+
+    def __init__(self, base_url, stats, timeout=60):
+        self.base_url = base_url.rstrip('/')
+        self.stats = stats
+        self.timeout = timeout
+        self.opener = build_opener(HTTPCookieProcessor(CookieJar()), NoRedirect)
+        self.csrf_token = None
+        self.location = None
+
+    def request(self, name, path, data=None):
+        """Send one request, timing it under ``name``; returns status and body.
+
+        The redirect target, if any, is kept in ``location``. A redirect to
+        the login page counts as an error, since the session was lost.
+        """
+        body = urlencode(data).encode('utf-8') if data is not None else None
+        start = time.time()
+        headers = {}
+        try:
+            response = self.opener.open(self.base_url + path, body, self.timeout)
+            status, content, headers = response.status, response.read(), response.headers
+        except HTTPError as e:
+            status, content, headers = e.code, e.read(), e.headers
+        except (URLError, OSError):
+            status, content = None, b''
+        self.location = urlparse(headers.get('Location') or '').path or None
+        error = (status is None or status >= 400
+                 or (self.location or '').startswith('/auth/login'))
+        self.stats.add(name, time.time() - start, error)
+        return status, content.decode('utf-8', 'replace')
+
+    def form(self, name, path, data):
+        """Fetch the form page at ``path`` and submit ``data`` with its CSRF token."""
+        status, content = self.request(name + ' GET', path)
+        match = CSRF_TOKEN.search(content)
+        if match:
+            self.csrf_token = match.group(1)
+        if self.csrf_token:
+            data = dict(data, csrf_token=self.csrf_token)
+        return self.request(name + ' POST', path, data)
+
+    def login(self, number, password):
+        """Log in as ``number``; a login that does not land on the user
+        index stops the run."""
+        status, content = self.form(
+            'auth.login', '/auth/login', {'username': number, 'password': password})
+        if status != 302 or self.location != '/user/':
+            raise click.ClickException('Could not log in as %s (status %s).' % (number, status))
+
+
+def think(rng, mean):
+    time.sleep(rng.expovariate(1.0 / mean) if mean else 0)
+
+
+def student(client, fixture, rng, deadline, think_time):
+    while time.time() < deadline:
+        client.request('user.index', '/user/')
+        client.form('user.review', '/user/review/%d' % fixture['report_id'], {
+            'score': rng.randint(60, 100), 'remark': 'benchmark'})
+        think(rng, think_time)
+
+
+def teacher(client, fixture, rng, deadline, think_time):
+    while time.time() < deadline:
+        client.request('admin.manage_report', '/admin/manage/report/%d' % fixture['course_id'])
+        for page in range(1, fixture['pages'] + 1):
+            client.request('admin.manage_record', '/admin/manage/record-table/%d?page=%d'
+                           % (fixture['report_id'], page))
+            think(rng, think_time)
+
+
+def admin(client, fixture, rng, deadline, think_time):
+    while time.time() < deadline:
+        client.request('admin.download_report', '/admin/manage/report/%d/download' % fixture['course_id'])
+        client.request('admin.user_log', '/admin/manage/logs/user')
+        think(rng, think_time * 5)
+
+
+SCENARIOS = {'student': student, 'teacher': teacher, 'admin': admin}
+
+
+def create_benchmark_app(config_name, database):
+    """``create_app`` on ``database`` instead of the configured one.
+
+    The engine is only created on the first query, so replacing the URI
+    right after ``create_app`` is enough.
+    """
+    from recordit import create_app
+
+    app = create_app(config_name)
+    if database:
+        app.config['SQLALCHEMY_DATABASE_URI'] = database
+    if not app.config.get('ADMIN_NUMBER'):
+        app.config['ADMIN_NUMBER'] = 'admin'
+    return app
+
+
+def forge_database(scale, seed):
+    from recordit.extensions import db
+    from recordit.fakes import fake_admin, forge
+    from recordit.models import Role
+
+    db.drop_all()
+    db.create_all()
+    Role.init_role()
+    fake_admin()
+    return forge(scale, seed)
+
+
+def serve(app):
+    """Serve ``app`` from a threaded server on a free local port."""
+    from werkzeug.serving import make_server
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d' % server.server_port
+
+
+def fixtures(app, students, teachers, admins):
+    """Accounts and targets of the virtual users, as ``(role, fixture)``.
+
+    Students all review the report of the largest grade that has the most
+    reviews so far; each teacher pages through the busiest report of one
+    of their courses.
+    """
+    from sqlalchemy import func
+
+    from recordit.extensions import db
+    from recordit.models import Course, RecordTable, Report, User, role_registry
+
+    busiest = db.session.query(
+        Report.id, Report.course_id, Report.speaker_id, Course.grade, Course.teacher_id
+    ).join(Course, Report.course_id == Course.id).join(
+        RecordTable, RecordTable.report_id == Report.id).filter(
+        Report.active, Course.active).group_by(
+        Report.id, Report.course_id, Report.speaker_id, Course.grade, Course.teacher_id
+    ).order_by(func.count(RecordTable.id).desc())
+
+    report = busiest.first()
+    per_page = app.config['MANAGE_RECORD_TABLE_PER_PAGE']
+    users = []
+
+    numbers = [number for number, in db.session.query(User.number).filter(
+        User.role_id == role_registry.id('Student'), User.number.like(report.grade + '%'),
+        User.id != report.speaker_id).order_by(User.id).limit(students)]
+    users.extend(('student', {'number': number, 'report_id': report.id}) for number in numbers)
+
+    seen = set()
+    for row in busiest:
+        if len(seen) == teachers:
+            break
+        if row.teacher_id in seen:
+            continue
+        seen.add(row.teacher_id)
+        count = RecordTable.query.filter_by(report_id=row.id).count()
+        users.append(('teacher', {
+            'number': User.query.get(row.teacher_id).number,
+            'course_id': row.course_id,
+            'report_id': row.id,
+            'pages': max(1, -(-count // per_page)),
+        }))
+
+    users.extend(('admin', {
+        'number': app.config['ADMIN_NUMBER'], 'course_id': report.course_id,
+    }) for _ in range(admins))
+    return users
+
+
+def run(base_url, users, password, duration, think_time, seed):
+    """Log every virtual user in, then let them all loose for ``duration``."""
+    stats = Stats()
+    login_stats = Stats()
+    clients = []
+    for role, fixture in users:
+        client = Client(base_url, login_stats)
+        client.login(fixture['number'], password)
+        clients.append(client)
+    for client in clients:
+        client.stats = stats
+
+    deadline = time.time() + duration
+    threads = []
+    for i, ((role, fixture), client) in enumerate(zip(users, clients)):
+        thread = threading.Thread(target=SCENARIOS[role], args=(
+            client, fixture, random.Random(seed + i), deadline, think_time))
+        thread.daemon = True
+        threads.append(thread)
+
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return stats.summary(time.time() - start)
+
+
+@click.command()
+@click.option('--config', default='production', help='Configuration name, default is production.')
+@click.option('--database', default='sqlite:///benchmark.db', help='Database URI of the run.')
+@click.option('--url', help='Load an already running server instead of a local one.')
+@click.option('--forge/--no-forge', default=True, help='Rebuild the database first, default is on.')
+@click.option('--scale', default=1.0, help='Fake data scale, default is 1.')
+@click.option('--seed', default=0, help='Random seed, default is 0.')
+@click.option('--students', default=40, help='Concurrent students, default is 40.')
+@click.option('--teachers', default=5, help='Concurrent teachers, default is 5.')
+@click.option('--admins', default=1, help='Concurrent administrators, default is 1.')
+@click.option('--duration', default=60.0, help='Seconds of load, default is 60.')
+@click.option('--think', 'think_time', default=1.0, help='Mean pause between steps in seconds, default is 1.')
+@click.option('--output', default='loadtest.json', help='Result file, default is loadtest.json.')
+def main(config, database, url, forge, scale, seed, students, teachers, admins,
+         duration, think_time, output):
+    """Load the app with a realistic mix of users."""
+    app = create_benchmark_app(config, database)
+
+    with app.app_context():
+        if forge:
+            click.echo('Forging scale %g...' % scale)
+            forge_database(scale, seed)
+        users = fixtures(app, students, teachers, admins)
+
+    server = None
+    if url is None:
+        server, url = serve(app)
+
+    click.echo('Running %d users against %s for %gs...' % (len(users), url, duration))
+    try:
+        results = run(url, users, app.config['ADMIN_PASSWORD'], duration, think_time, seed)
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    document = write_results(output, 'loadtest', {
+        'config': config, 'database': database, 'url': url, 'scale': scale, 'seed': seed,
+        'students': students, 'teachers': teachers, 'admins': admins,
+        'duration': duration, 'think': think_time,
+    }, results)
+    echo_results(document)
+    click.echo('Results written to %s.' % output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""Microbenchmarks of the helpers every page leans on.
+
+Run with ``python -m recordit.benchmarks.micro``. The model benchmarks run
+on ``TestingConfig``'s in-memory database forged at each ``--scale``; the
+pure helpers run once. Each benchmark reports its p50/p95/p99 time per
+call, calls per second, and the peak and retained memory of a call as
+seen by ``tracemalloc``.
+
+Results use the format of ``recordit.benchmarks.results``; ``--append``
+adds them to a load test result file, so that one file per commit covers
+both and ``python -m recordit.benchmarks.results`` compares them together.
+"""
+
+import time
+import tracemalloc
+
+import click
+
+from recordit.benchmarks.results import (echo_results, read_results,
+                                         summarize, write_results)
+
+FILENAME = u'第三周 课程报告（终稿）.pdf'
+PAGE_SIZE = 30
+
+
+def user_can():
+    from recordit.models import User, role_registry
+
+    user = User.query.filter_by(role_id=role_registry.id('Student')).first()
+    return lambda: user.can('ADMINISTER')
+
+
+def user_grade():
+    from recordit.models import User, role_registry
+
+    user = User.query.filter_by(role_id=role_registry.id('Student')).first()
+    return lambda: user.grade
+
+
+def user_all_grade():
+    from recordit.models import User
+
+    return User.all_grade
+
+
+def report_properties(eager_load=False):
+    """Read the properties a report list shows, for one fresh page."""
+    from recordit.extensions import db
+    from recordit.models import Course, Report, eager
+
+    def run():
+        db.session.expunge_all()
+        query = Report.query
+        if eager_load:
+            query = query.options(eager(Report.course, Course.teacher), eager(Report.speaker))
+        for report in query.limit(PAGE_SIZE):
+            (report.course_name, report.speaker_name, report.teacher_name,
+             report.is_active, report.teacher_score, report.student_score,
+             report.score_variance)
+    return run
+
+
+def recordtable_properties(eager_load=False):
+    """Read the properties a record table list shows, for one fresh page."""
+    from recordit.extensions import db
+    from recordit.models import RecordTable, Report, eager
+
+    def run():
+        db.session.expunge_all()
+        query = RecordTable.query
+        if eager_load:
+            query = query.options(
+                eager(RecordTable.report, Report.course), eager(RecordTable.reviewer))
+        for record in query.limit(PAGE_SIZE):
+            (record.report_name, record.reviewer_name, record.reviewer_number,
+             record.course_id, record.teacher_id)
+    return run
+
+
+def safe_filename():
+    from recordit.utils import safe_filename
+
+    return lambda: safe_filename(FILENAME)
+
+
+def gen_uuid():
+    from recordit.utils import gen_uuid
+
+    return lambda: gen_uuid(FILENAME)
+
+
+def zipstream():
+    """Archive a spreadsheet-sized member and ten image-sized ones."""
+    import os
+
+    from recordit.utils import zipstream
+
+    members = [('records.xlsx', os.urandom(256 * 1024))]
+    members.extend(('uploads/%d.jpg' % i, os.urandom(64 * 1024)) for i in range(10))
+
+    def run():
+        for chunk in zipstream(members):
+            pass
+    return run
+
+
+# name -> (setup returning the call to time, whether it depends on the data)
+BENCHMARKS = {
+    'user.can': (user_can, True),
+    'user.grade': (user_grade, True),
+    'user.all_grade': (user_all_grade, True),
+    'report.properties': (report_properties, True),
+    'report.properties.eager': (lambda: report_properties(True), True),
+    'recordtable.properties': (recordtable_properties, True),
+    'recordtable.properties.eager': (lambda: recordtable_properties(True), True),
+    'utils.safe_filename': (safe_filename, False),
+    'utils.gen_uuid': (gen_uuid, False),
+    'utils.zipstream': (zipstream, False),
+}
+
+
+def measure(func, min_time, max_calls=100000):
+    """Time ``func`` for at least ``min_time`` seconds, then trace the memory
+    of a few more calls."""
+    start = time.perf_counter()
+    first = None
+    latencies = []
+    while len(latencies) < max_calls and time.perf_counter() - start < min_time:
+        begin = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - begin)
+        if first is None:
+            first = latencies[-1]
+
+    result = summarize(latencies)
+    result['first'] = first
+    result['ops'] = len(latencies) / sum(latencies) if sum(latencies) else None
+
+    calls = min(len(latencies), 100)
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        for _ in range(calls):
+            func()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    result['peak_bytes'] = peak - before
+    result['retained_bytes'] = (current - before) // calls if calls else None
+    return result
+
+
+@click.command()
+@click.option('--scale', 'scales', multiple=True, type=float,
+              help='Fake data scale, repeatable, default is 0.1, 1 and 5.')
+@click.option('--min-time', default=0.5, help='Seconds spent on each benchmark, default is 0.5.')
+@click.option('--benchmark', 'names', multiple=True, help='Only run this benchmark.')
+@click.option('--output', default='micro.json', help='Result file, default is micro.json.')
+@click.option('--append', type=click.Path(exists=True),
+              help='Add the results to this load test result file instead.')
+def main(scales, min_time, names, output, append):
+    """Time the core helpers in isolation."""
+    from recordit.benchmarks.loadtest import create_benchmark_app, forge_database
+
+    scales = scales or (0.1, 1.0, 5.0)
+    names = names or sorted(BENCHMARKS)
+    app = create_benchmark_app('testing', None)
+    results = {}
+
+    with app.app_context(), app.test_request_context():
+        # the pure helpers first, so their first call includes lazy imports
+        for name in names:
+            setup, sized = BENCHMARKS[name]
+            if not sized:
+                click.echo('Running %s...' % name)
+                results['micro.' + name] = measure(setup(), min_time)
+
+        for scale in scales:
+            click.echo('Forging scale %g...' % scale)
+            forge_database(scale, 0)
+            for name in names:
+                setup, sized = BENCHMARKS[name]
+                if sized:
+                    click.echo('Running %s at scale %g...' % (name, scale))
+                    results['micro.%s@%g' % (name, scale)] = measure(setup(), min_time)
+
+    settings = {'scales': list(scales), 'min_time': min_time}
+    if append:
+        document = read_results(append)
+        document['results'].update(results)
+        document['settings']['micro'] = settings
+        write_results(append, document['kind'], document['settings'], document['results'])
+        output = append
+    else:
+        write_results(output, 'micro', settings, results)
+
+    echo_results({'results': results})
+    click.echo('Results written to %s.' % output)
+
+
+if __name__ == '__main__':
+    main()
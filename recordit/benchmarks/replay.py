@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""Replay recorded traffic against a local instance.
+
+Capture traces in production with ``TRACE_CAPTURE=1`` (see
+``recordit.traces``), then run::
+
+    python -m recordit.benchmarks.replay logs/traces.log* --speed 1
+
+The app is set up as in ``recordit.benchmarks.loadtest``. Every traced
+user is logged in as a local account of the same role, every pseudonymous
+id is mapped to a local object of the same kind, the busiest ones first,
+and the requests are sent at their recorded offsets divided by ``--speed``.
+Of the writes only reviews are replayed. For each endpoint the replayed
+latencies are reported next to the traced ones, with their difference.
+The two measure different things: replayed latencies are taken by the
+client over the whole response, traced ones by the server from the start
+of the request to the last byte of the body. The difference therefore
+includes the connection and the client as well as any change of the
+server, and is best compared between runs rather than read on its own.
+"""
+
+import gzip
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+import click
+
+from recordit.benchmarks.loadtest import (Client, Stats, create_benchmark_app,
+                                          forge_database, serve)
+from recordit.benchmarks.results import (echo_results, percentile, summarize,
+                                         write_results)
+
+# writes that are safe to repeat, with the form data to send
+WRITES = {
+    'user.review': lambda rng: {'score': rng.randint(60, 100), 'remark': 'replay'},
+}
+
+
+def read_traces(files, endpoints=None, limit=None):
+    """Traced requests of ``files``, plain or rotated and gzipped, in time order."""
+    entries = []
+    for file in files:
+        opener = gzip.open if file.endswith('.gz') else open
+        with opener(file, 'rt') as f:
+            for line in f:
+                entry = json.loads(line)
+                if endpoints and entry['endpoint'] not in endpoints:
+                    continue
+                if entry['method'] != 'GET' and entry['endpoint'] not in WRITES:
+                    continue
+                entries.append(entry)
+    entries.sort(key=lambda entry: entry['time'])
+    return entries[:limit] if limit else entries
+
+
+class Mapper(object):
+    """Stand-ins for the pseudonyms of a trace, taken from the local database.
+
+    Each new pseudonym gets the next object of its pool, so the objects a
+    trace uses most map to the busiest local ones when pseudonyms first
+    appear in order of their popularity. The courses and reports a teacher
+    asks for are taken from the courses of the teacher's local account
+    instead, since teachers may only see and review their own.
+    """
+
+    def __init__(self, app):
+        from sqlalchemy import func
+
+        from recordit.extensions import db
+        from recordit.models import Course, RecordTable, Report, User, role_registry
+
+        def users(role):
+            return [number for number, in db.session.query(User.number).filter(
+                User.role_id == role_registry.id(role)).order_by(User.id)]
+
+        self.accounts = {
+            'Administrator': [app.config['ADMIN_NUMBER']],
+            'Teacher': users('Teacher'),
+            'Student': users('Student'),
+        }
+        self.pools = {
+            'report_id': [id for id, in db.session.query(Report.id).outerjoin(
+                RecordTable, RecordTable.report_id == Report.id).group_by(Report.id).order_by(
+                func.count(RecordTable.id).desc())],
+            'course_id': [id for id, in db.session.query(Course.id).outerjoin(
+                Report, Report.course_id == Course.id).group_by(Course.id).order_by(
+                func.count(Report.id).desc())],
+            'record_id': [id for id, in db.session.query(RecordTable.id).order_by(RecordTable.id)],
+            'user_id': [id for id, in db.session.query(User.id).filter(
+                User.role_id == role_registry.id('Student')).order_by(User.id)],
+        }
+        self.teachers = {}
+        reports = db.session.query(Report.id, User.number).join(
+            Course, Report.course_id == Course.id).join(
+            User, Course.teacher_id == User.id).outerjoin(
+            RecordTable, RecordTable.report_id == Report.id).group_by(
+            Report.id, User.number).order_by(func.count(RecordTable.id).desc())
+        for id, number in reports:
+            self.teacher_pools(number)['report_id'].append(id)
+        courses = db.session.query(Course.id, User.number).join(
+            User, Course.teacher_id == User.id).outerjoin(
+            Report, Report.course_id == Course.id).group_by(
+            Course.id, User.number).order_by(func.count(Report.id).desc())
+        for id, number in courses:
+            self.teacher_pools(number)['course_id'].append(id)
+        self.seen = {}
+
+    def teacher_pools(self, number):
+        return self.teachers.setdefault(number, {'report_id': [], 'course_id': []})
+
+    def next(self, kind, pool, pseudonym):
+        mapping = self.seen.setdefault(kind, {})
+        if pseudonym not in mapping:
+            if not pool:
+                return None
+            mapping[pseudonym] = pool[len(mapping) % len(pool)]
+        return mapping[pseudonym]
+
+    def account(self, role, pseudonym):
+        return self.next(role, self.accounts.get(role), pseudonym)
+
+    def args(self, args, teacher=None):
+        """Local URL arguments for traced ``args`` of a request by the local
+        ``teacher`` account, if any, or None when one has no local
+        counterpart, like an uploaded file."""
+        teacher_pools = self.teachers.get(teacher, {}) if teacher else {}
+        local = {}
+        for key, value in args.items():
+            if key in teacher_pools:
+                value = self.next((key, teacher), teacher_pools[key], value)
+            elif key in self.pools:
+                value = self.next(key, self.pools[key], value)
+            elif isinstance(value, str) and value.startswith(key + ':'):
+                return None
+            if value is None:
+                return None
+            local[key] = value
+        return local
+
+
+def plan(app, entries, mapper):
+    """Resolve each traced request to ``(entry, account, path)``; requests
+    without a local counterpart are dropped."""
+    from flask import url_for
+    from werkzeug.routing import BuildError
+
+    requests = []
+    with app.test_request_context():
+        for entry in entries:
+            account = None
+            if entry['user']:
+                account = mapper.account(entry['role'], entry['user'])
+                if account is None:
+                    continue
+            teacher = account if entry['role'] == 'Teacher' else None
+            args = mapper.args(entry['args'], teacher)
+            if args is None:
+                continue
+            try:
+                path = url_for(entry['endpoint'], **args)
+            except BuildError:
+                continue
+            if entry['query']:
+                path += '?' + urlencode(entry['query'])
+            requests.append((entry, account, path))
+    return requests
+
+
+def replay(base_url, requests, password, speed, workers, seed):
+    """Send ``requests`` at their traced offsets divided by ``speed``.
+
+    Returns the statistics and how late each request was sent.
+    """
+    stats = Stats()
+    login_stats = Stats()
+    rng = random.Random(seed)
+    lock = threading.Lock()
+    lags = []
+
+    accounts = set(account for entry, account, path in requests)
+    clients = dict((account, Client(base_url, login_stats)) for account in accounts)
+    with ThreadPoolExecutor(workers) as executor:
+        list(executor.map(lambda account: account and clients[account].login(account, password),
+                          accounts))
+    for client in clients.values():
+        client.stats = stats
+
+    def send(client, name, path, data, due):
+        with lock:
+            lags.append(time.time() - due)
+        if data is not None and client.csrf_token:
+            data = dict(data, csrf_token=client.csrf_token)
+        client.request(name, path, data)
+
+    start = time.time()
+    first = requests[0][0]['time'] if requests else 0
+    with ThreadPoolExecutor(workers) as executor:
+        for entry, account, path in requests:
+            due = start + (entry['time'] - first) / speed
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            data = None
+            if entry['method'] != 'GET':
+                data = WRITES[entry['endpoint']](rng)
+            name = '%s %s' % (entry['endpoint'], entry['method'])
+            executor.submit(send, clients[account], name, path, data, due)
+
+    return stats.summary(time.time() - start), sorted(lags)
+
+
+def traced(entries):
+    """Recorded server-side durations per replay name."""
+    durations = {}
+    for entry in entries:
+        name = '%s %s' % (entry['endpoint'], entry['method'])
+        durations.setdefault(name, []).append(entry['duration'])
+    return dict((name, summarize(values)) for name, values in durations.items())
+
+
+@click.command()
+@click.argument('files', nargs=-1, required=True, type=click.Path(exists=True))
+@click.option('--config', default='production', help='Configuration name, default is production.')
+@click.option('--database', default='sqlite:///benchmark.db', help='Database URI of the run.')
+@click.option('--url', help='Replay against an already running server instead of a local one.')
+@click.option('--forge/--no-forge', default=True, help='Rebuild the database first, default is on.')
+@click.option('--scale', default=1.0, help='Fake data scale, default is 1.')
+@click.option('--seed', default=0, help='Random seed, default is 0.')
+@click.option('--speed', default=1.0, help='Replay speed, 2 sends twice as fast, default is 1.')
+@click.option('--workers', default=50, help='Concurrent requests at most, default is 50.')
+@click.option('--endpoint', 'endpoints', multiple=True, help='Only replay this endpoint.')
+@click.option('--limit', type=int, help='Only replay the first LIMIT requests.')
+@click.option('--output', default='replay.json', help='Result file, default is replay.json.')
+def main(files, config, database, url, forge, scale, seed, speed, workers, endpoints,
+         limit, output):
+    """Replay recorded traces and compare the latencies."""
+    entries = read_traces(files, endpoints, limit)
+    click.echo('Read %d requests.' % len(entries))
+
+    app = create_benchmark_app(config, database)
+    with app.app_context():
+        if forge:
+            click.echo('Forging scale %g...' % scale)
+            forge_database(scale, seed)
+        requests = plan(app, entries, Mapper(app))
+    click.echo('Replaying %d requests at %gx...' % (len(requests), speed))
+
+    server = None
+    if url is None:
+        server, url = serve(app)
+    try:
+        results, lags = replay(url, requests, app.config['ADMIN_PASSWORD'], speed, workers, seed)
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    recorded = traced(entry for entry, account, path in requests)
+    for name, result in results.items():
+        for figure in ('p50', 'p95', 'p99'):
+            before = recorded.get(name, {}).get(figure)
+            result['traced_' + figure] = before
+            result['delta_' + figure] = None if before is None else result[figure] - before
+
+    document = write_results(output, 'replay', {
+        'files': list(files), 'config': config, 'database': database, 'url': url,
+        'scale': scale, 'seed': seed, 'speed': speed, 'workers': workers,
+        'requests': len(requests), 'lag_p95': percentile(lags, 95),
+    }, results)
+    echo_results(document)
+
+    click.echo('Δ is client-side replay time minus server-side traced time.')
+    click.echo('%-40s %9s %9s %9s' % ('name', 'Δp50 ms', 'Δp95 ms', 'Δp99 ms'))
+    for name, result in sorted(results.items()):
+        click.echo('%-40s %9s %9s %9s' % tuple([name] + [
+            '-' if result['delta_' + figure] is None else '%+.1f' % (result['delta_' + figure] * 1000)
+            for figure in ('p50', 'p95', 'p99')]))
+    click.echo('Requests were sent up to %.0f ms late (p95).' % ((document['settings']['lag_p95'] or 0) * 1000))
+    click.echo('Results written to %s.' % output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""Machine-readable benchmark results.
+
+Every benchmark writes one JSON document of the form::
+
+    {"kind": "loadtest", "commit": "...", "time": "...", "python": "...",
+     "settings": {...}, "results": {"<name>": {"count": ..., "p50": ..., ...}}}
+
+so that runs of different commits, and of different benchmarks, can be
+compared with ``python -m recordit.benchmarks.results OLD NEW``.
+"""
+
+import datetime
+import json
+import platform
+import subprocess
+
+import click
+
+# figures where a higher value is the better one
+HIGHER_IS_BETTER = ('throughput', 'ops')
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def percentile(values, q):
+    """The ``q`` percentile of sorted ``values``, by nearest rank."""
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, int(round(q / 100.0 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def summarize(latencies, errors=0, duration=None):
+    """Count, error rate, mean and percentiles of ``latencies`` in seconds."""
+    values = sorted(latencies)
+    count = len(values)
+    summary = {
+        'count': count,
+        'errors': errors,
+        'error_rate': float(errors) / count if count else 0.0,
+        'mean': sum(values) / count if count else None,
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': values[-1] if values else None,
+    }
+    if duration:
+        summary['throughput'] = count / duration
+    return summary
+
+
+def write_results(file, kind, settings, results):
+    document = {
+        'kind': kind,
+        'commit': git_commit(),
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'settings': settings,
+        'results': results,
+    }
+    with open(file, 'w') as f:
+        json.dump(document, f, indent=2, sort_keys=True)
+    return document
+
+
+def read_results(file):
+    with open(file) as f:
+        return json.load(f)
+
+
+def compare(old, new, figures=('p50', 'p95', 'p99', 'throughput', 'error_rate', 'ops',
+                              'peak_bytes', 'retained_bytes')):
+    """Rows of ``(name, figure, old, new, change)`` for every figure both
+    result documents have; ``change`` is relative, positive when worse."""
+    rows = []
+    for name in sorted(set(old['results']) & set(new['results'])):
+        for figure in figures:
+            a = old['results'][name].get(figure)
+            b = new['results'][name].get(figure)
+            if a is None or b is None:
+                continue
+            change = (b - a) / a if a else 0.0
+            if figure in HIGHER_IS_BETTER:
+                change = -change
+            rows.append((name, figure, a, b, change))
+    return rows
+
+
+def echo_results(document):
+    click.echo('%-40s %8s %7s %9s %9s %9s %9s' % (
+        'name', 'count', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s'))
+    for name, result in sorted(document['results'].items()):
+        click.echo('%-40s %8d %7d %9s %9s %9s %9s' % (
+            name, result['count'], result.get('errors', 0),
+            milliseconds(result.get('p50')), milliseconds(result.get('p95')),
+            milliseconds(result.get('p99')),
+            '%.1f' % result['throughput'] if result.get('throughput') else '-'))
+
+
+def milliseconds(value):
+    return '-' if value is None else '%.1f' % (value * 1000)
+
+
+@click.command()
+@click.argument('old', type=click.Path(exists=True))
+@click.argument('new', type=click.Path(exists=True))
+@click.option('--threshold', default=0.1, help='Relative change reported as a regression, default is 0.1.')
+def main(old, new, threshold):
+    """Compare two benchmark result files."""
+    old = read_results(old)
+    new = read_results(new)
+    click.echo('%s (%s) -> %s (%s)' % (old['kind'], old['commit'], new['kind'], new['commit']))
+
+    regressions = 0
+    for name, figure, a, b, change in compare(old, new):
+        flag = ''
+        if change > threshold:
+            flag = ' REGRESSION'
+            regressions += 1
+        click.echo('%-40s %-10s %12.6g %12.6g %+7.1f%%%s' % (name, figure, a, b, change * 100, flag))
+
+    if regressions:
+        raise click.ClickException('%d regressions.' % regressions)
+
+
+if __name__ == '__main__':
+    main()
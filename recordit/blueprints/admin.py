@@ -1,11 +1,19 @@
 # -*- coding: utf-8 -*-
 
-from flask import (Blueprint, abort, current_app, flash, render_template,
-                   request, send_file)
+import time
+
+from flask import (Blueprint, abort, current_app, flash, jsonify, redirect,
+                   render_template, request, send_file, url_for)
 from flask_babel import _
 from flask_login import current_user, fresh_login_required, login_required
 
+from recordit.audit import Event, archived_months
 from recordit.decorators import permission_required, role_required
+from recordit.exports import (DEFAULT_EXPORT_FORMAT, EXPORT_FORMATS,
+                              archived_log_members, cached_zip, export_file,
+                              export_key, export_status, log_members,
+                              parse_export_job_id, record_members,
+                              record_query, record_version, submit_export)
 from recordit.extensions import db
 from recordit.forms.admin import (
     AddCourseAdministratorForm, AddCourseTeacherForm, AddReportBatchForm,
@@ -13,9 +21,14 @@ from recordit.forms.admin import (
     DeleteUserForm, EditAdministratorForm, EditStudenteForm, EditTeacherForm,
     RegisterAdministratorForm, RegisterBatchForm, RegisterStudentForm,
     RegisterTeacherForm, SwitchStateForm)
-from recordit.models import Course, Log, RecordTable, Report, Role, User
-from recordit.utils import (flash_errors, log_user, packitup, redirect_back,
-                            safe_filename)
+from recordit.imports import (REPORT_COLUMNS, USER_COLUMNS, SpreadsheetError,
+                              import_reports, import_users, read_rows)
+from recordit.metrics import metrics
+from recordit.models import (Course, Log, RecordTable, Report, User, eager,
+                             role_registry)
+from recordit.profiler import profile_file, profiler
+from recordit.sqlstats import sqlstats
+from recordit.utils import log_user, redirect_back, send_zip
 
 admin_bp = Blueprint('admin', __name__)
 
@@ -30,15 +43,15 @@ def login_protect():
 
 @admin_bp.route('/')
 def index():
-    log_user(content=render_template('logs/admin/index.html'))
+    log_user(Event.ADMIN_INDEX)
 
     user_count = User.query.count()
-    role_administrator = Role.query.filter_by(name='Administrator').one()
-    admin_count = User.query.filter_by(role_id=role_administrator.id).count()
-    role_teacher = Role.query.filter_by(name='Teacher').one()
-    teacher_count = User.query.filter_by(role_id=role_teacher.id).count()
-    role_student = Role.query.filter_by(name='Student').one()
-    student_count = User.query.filter_by(role_id=role_student.id).count()
+    admin_count = User.query.filter_by(
+        role_id=role_registry.id('Administrator')).count()
+    teacher_count = User.query.filter_by(
+        role_id=role_registry.id('Teacher')).count()
+    student_count = User.query.filter_by(
+        role_id=role_registry.id('Student')).count()
     log_count = Log.query.count()
     course_count = Course.query.count()
 
@@ -55,23 +68,22 @@ def index():
 @admin_bp.route('/manage/user')
 @permission_required('ADMINISTER')
 def manage_user():
-    log_user(content=render_template('logs/admin/manage_user.html'))
+    log_user(Event.MANAGE_USER)
 
     # 'all', 'student', 'teacher', 'administrator'
     filter_rule = request.args.get('filter', 'all')
     page = request.args.get('page', 1, type=int)
     per_page = current_app.config['MANAGE_USER_PER_PAGE']
-    role_administrator = Role.query.filter_by(
-        name='Administrator').one()
-    role_teacher = Role.query.filter_by(name='Teacher').one()
-    role_student = Role.query.filter_by(name='Student').one()
 
     if filter_rule == 'student':
-        filtered_users = User.query.filter_by(role=role_student)
+        filtered_users = User.query.filter_by(
+            role_id=role_registry.id('Student'))
     elif filter_rule == 'teacher':
-        filtered_users = User.query.filter_by(role=role_teacher)
+        filtered_users = User.query.filter_by(
+            role_id=role_registry.id('Teacher'))
     elif filter_rule == 'administrator':
-        filtered_users = User.query.filter_by(role=role_administrator)
+        filtered_users = User.query.filter_by(
+            role_id=role_registry.id('Administrator'))
     else:
         filtered_users = User.query
 
@@ -88,9 +100,7 @@ def manage_user():
 def delete_user(user_id):
     user = User.query.get_or_404(user_id)
 
-    content = render_template(
-        'logs/admin/delete_user.html', username=user.username, name=user.name)
-    log_user(content)
+    log_user(Event.DELETE_USER, username=user.username, name=user.name)
 
     db.session.delete(user)
     db.session.commit()
@@ -111,12 +121,12 @@ def edit_profile(user_id):
         form = EditStudenteForm()
 
     if form.validate_on_submit():
-        content = render_template(
-            'logs/admin/edit_profile.html',
-            username_old=user.username, name_old=user.name,
-            username_new=form.name.data, user_new=form.username.data)
-        log_user(content)
+        log_user(
+            Event.EDIT_PROFILE, username_old=user.username, name_old=user.name,
+            username_new=form.username.data, name_new=form.name.data)
 
+        if (user.number, user.name) != (form.username.data, form.name.data):
+            Report.touch_user(user.id)
         user.number = form.username.data
         user.name = form.name.data
         user.remark = form.remark.data
@@ -139,10 +149,8 @@ def change_password(user_id):
     form = ChangePasswordForm()
     if form.validate_on_submit():
         if user.validate_password(form.old_password.data):
-            content = render_template(
-                'logs/admin/change_password.html',
-                username=user.username, name=user.name)
-            log_user(content)
+            log_user(
+                Event.CHANGE_PASSWORD, username=user.username, name=user.name)
 
             user.set_password(form.password.data)
             db.session.commit()
@@ -160,10 +168,9 @@ def change_password(user_id):
 def register_student():
     form = RegisterStudentForm()
     if form.validate_on_submit():
-        content = render_template(
-            'logs/admin/register_user.html',
-            username=form.username.data, name=form.name.data)
-        log_user(content)
+        log_user(
+            Event.REGISTER_USER, username=form.username.data,
+            name=form.name.data)
 
         user = User(
             number=form.username.data,
@@ -173,6 +180,7 @@ def register_student():
         user.set_password(form.password.data)
         user.set_role('Student')
         db.session.add(user)
+        db.session.commit()
 
         flash(_('Register success.'), 'success')
         return redirect_back()
@@ -185,10 +193,9 @@ def register_student():
 def register_teacher():
     form = RegisterTeacherForm()
     if form.validate_on_submit():
-        content = render_template(
-            'logs/admin/register_user.html',
-            username=form.username.data, name=form.name.data)
-        log_user(content)
+        log_user(
+            Event.REGISTER_USER, username=form.username.data,
+            name=form.name.data)
 
         user = User(
             number=form.username.data,
@@ -198,6 +205,7 @@ def register_teacher():
         user.set_password(form.password.data)
         user.set_role('Teacher')
         db.session.add(user)
+        db.session.commit()
 
         flash(_('Register success.'), 'success')
         return redirect_back()
@@ -210,10 +218,9 @@ def register_teacher():
 def register_administrator():
     form = RegisterAdministratorForm()
     if form.validate_on_submit():
-        content = render_template(
-            'logs/admin/register_user.html',
-            username=form.username.data, name=form.name.data)
-        log_user(content)
+        log_user(
+            Event.REGISTER_USER, username=form.username.data,
+            name=form.name.data)
 
         user = User(
             number=form.username.data,
@@ -223,6 +230,7 @@ def register_administrator():
         user.set_password(form.password.data)
         user.set_role('Administrator')
         db.session.add(user)
+        db.session.commit()
 
         flash(_('Register success.'), 'success')
         return redirect_back()
@@ -233,55 +241,27 @@ def register_administrator():
 @admin_bp.route('manage/user/register/batch', methods=['GET', 'POST'])
 @permission_required('ADMINISTER')
 def register_batch():
-    from os import path
-    from uuid import uuid4
-
-    import pandas as pd
-
     form = RegisterBatchForm()
     if form.validate_on_submit():
         file = request.files.get('file')
-        path = path.join(
-            current_app.config['FILE_CACHE_PATH'], safe_filename(file.filename))
-        file.save(path)
-        df = pd.read_excel(path)
-
-        if not set(df.columns) >= set(['number', 'name', 'role', 'remark', 'password']):
-            flash(
-                _("The EXCEL file columns should contain 'number', 'name', 'role', 'remark' and 'password'."), 'error')
+        start = time.time()
+        try:
+            results = import_users(read_rows(file, USER_COLUMNS))
+        except SpreadsheetError as e:
+            flash(str(e), 'error')
             return redirect_back()
 
-        for i, row in df.iterrows():
-            content = render_template(
-                'logs/admin/register_user.html',
-                username=row['number'], name=row['name'])
-            log_user(content)
-
-            if not User.query.filter_by(number=row['number']).one_or_none():
-                if row['role'] not in ['Teacher', 'Student']:
-                    flash(_("%(number)s role should be 'Student' or 'Teacher'.",
-                            number=row['number']), 'error')
-                else:
-                    user = User(
-                        number=row['number'],
-                        name=row['name'],
-                        remark=row['remark']
-                    )
-                    user.set_password(row['password'])
-                    user.set_role(row['role'])
-                    db.session.add(user)
-
-                    try:
-                        db.session.commit()
-                    except:
-                        db.session.rollback()
-            else:
-                flash(_("%(number)s is already existed.",
-                        number=row['number']), 'error')
-
-        flash_errors(form)
-        flash(_('Register success.'), 'success')
-        return redirect_back()
+        created = sum(1 for result in results if result['status'] == 'created')
+        log_user(Event.REGISTER_BATCH, file=file.filename,
+                 created=created, failed=len(results) - created)
+
+        metrics.observe('recordit_import_duration_seconds', time.time() - start, kind='users')
+        metrics.observe('recordit_import_rows', len(results),
+                        buckets=(10, 100, 1000, 10000, 100000), kind='users')
+
+        flash(_('%(created)d of %(total)d users registered.',
+                created=created, total=len(results)), 'success' if created == len(results) else 'warning')
+        return render_template('admin/register_batch.html', form=form, results=results)
 
     return render_template('admin/register_batch.html', form=form)
 
@@ -289,15 +269,14 @@ def register_batch():
 @admin_bp.route('manage/course')
 @permission_required('MODERATOR_COURSE')
 def manage_course():
-    log_user(content=render_template('logs/admin/manage_course.html'))
+    log_user(Event.MANAGE_COURSE)
 
     per_page = current_app.config['MANAGE_COURSE_PER_PAGE']
     page = request.args.get('page', 1, type=int)
-    pagination = Course.query.filter_by(
-        teacher_id=current_user.id).order_by(Course.date.desc()).paginate(page, per_page)
-    if current_user.is_admin:
-        pagination = Course.query.order_by(
-            Course.date.desc()).paginate(page, per_page)
+    query = Course.query.options(eager(Course.teacher))
+    if not current_user.is_admin:
+        query = query.filter_by(teacher_id=current_user.id)
+    pagination = query.order_by(Course.date.desc()).paginate(page, per_page)
 
     form = SwitchStateForm()
     return render_template('admin/manage_course.html', pagination=pagination, form=form)
@@ -308,9 +287,7 @@ def manage_course():
 def switch_course_state(course_id):
     course = Course.query.get_or_404(course_id)
 
-    content = render_template(
-        'logs/admin/switch_course_state.html', grade=course.grade, name=course.name)
-    log_user(content)
+    log_user(Event.SWITCH_COURSE_STATE, grade=course.grade, name=course.name)
 
     if current_user.is_teacher and course.teacher_id != current_user.id:
         abort(403)
@@ -333,9 +310,7 @@ def add_course():
         form = AddCourseAdministratorForm()
 
     if form.validate_on_submit():
-        content = render_template(
-            'logs/admin/add_course.html', grade=form.grade.data, name=form.name.data)
-        log_user(content)
+        log_user(Event.ADD_COURSE, grade=form.grade.data, name=form.name.data)
 
         if current_user.is_teacher:
             teacher_id = current_user.id
@@ -365,12 +340,13 @@ def manage_report(course_id):
         if course.teacher_id != current_user.id:
             abort(403)
 
-    log_user(content=render_template('logs/admin/manage_report.html'))
+    log_user(Event.MANAGE_REPORT)
 
     per_page = current_app.config['MANAGE_REPORT_PER_PAGE']
     page = request.args.get('page', 1, type=int)
-    pagination = Report.query.filter_by(course_id=course_id).order_by(
-        Report.date.desc()).paginate(page, per_page)
+    pagination = Report.query.options(
+        eager(Report.speaker), eager(Report.course)).filter_by(
+        course_id=course_id).order_by(Report.date.desc()).paginate(page, per_page)
 
     deleteform = DeleteReportForm()
     switchform = SwitchStateForm()
@@ -381,64 +357,25 @@ def manage_report(course_id):
 @admin_bp.route('manage/report/<int:course_id>/download')
 @permission_required('MODERATOR_REPORT')
 def download_report(course_id):
-    from os import path
-    from uuid import uuid4
-
-    import pandas as pd
-
     course = Course.query.get(course_id)
-    content = render_template(
-        'logs/admin/download_report.html', course=course.name)
-    log_user(content=content)
-
-    query = RecordTable.query.join(Report).filter_by(course_id=course_id)
-    df = pd.read_sql_query(query.statement, db.engine)
-
-    df['grade'] = (
-        df['report_id'].apply(lambda x: Report.query.get(x).grade))
-    df['course_name'] = (
-        df['report_id'].apply(lambda x: Report.query.get(x).course_name))
-    df['report_name'] = (
-        df['report_id'].apply(lambda x: Report.query.get(x).name))
-    df['speaker_name'] = (
-        df['report_id'].apply(lambda x: Report.query.get(x).speaker_name))
-    df['speaker_number'] = (
-        df['report_id'].apply(lambda x: Report.query.get(x).speaker_number))
-    df['reviewer_name'] = (
-        df['id'].apply(lambda x: RecordTable.query.get(x).reviewer_name))
-    df['reviewer_number'] = (
-        df['id'].apply(lambda x: RecordTable.query.get(x).reviewer_number))
-    df['teacher_name'] = (
-        df['report_id'].apply(lambda x: Report.query.get(x).teacher_name))
-    df['teacher_number'] = (
-        df['report_id'].apply(lambda x: Report.query.get(x).teacher_number))
-
-    df.drop(columns=['id', 'report_id', 'user_id'], inplace=True)
-
-    file = path.join(
-        current_app.config['FILE_CACHE_PATH'], uuid4().hex + '.xlsx')
-    df.to_excel(file, index=False)
-
-    zfile = file.replace('.xlsx', '.zip')
-
-    images = [path.join(current_app.config['UPLOAD_PATH'], rt.file)
-              for report in course.reports for rt in report.recordtables if rt.file]
-    packitup(file, zfile, mode='w')
-    packitup(images, zfile, mode='a', diff=True)
+    log_user(Event.DOWNLOAD_REPORT, course=course.name)
+
+    format = export_format()
+    members = record_members(record_query(course_id=course_id), 'reports', format)
+    version = record_version(course_id=course_id)
 
     flash(_('The file is already downloaded.'), 'success')
 
-    return send_file(zfile, as_attachment=True, attachment_filename='reports.zip')
+    return cached_zip(export_key('course', course_id, format), version, members, 'reports.zip')
 
 
 @admin_bp.route('manage/report/<int:report_id>/switch-state', methods=['POST'])
 @permission_required('MODERATOR_REPORT')
 def switch_report_state(report_id):
     report = Report.query.get_or_404(report_id)
-    content = render_template(
-        'logs/admin/switch_report_state.html',
-        grade=report.grade, course=report.course_name, report=report.name)
-    log_user(content)
+    log_user(
+        Event.SWITCH_REPORT_STATE, grade=report.grade,
+        course=report.course_name, report=report.name)
 
     if current_user.is_teacher and report.teacher_id != current_user.id:
         abort(403)
@@ -462,10 +399,9 @@ def add_report(course_id):
         course = Course.query.get_or_404(course_id)
         user = User.query.filter_by(number=form.speaker.data).one()
         if course.grade == user.grade:
-            content = render_template(
-                'logs/admin/add_report.html', course=course.name, grade=course.grade,
+            log_user(
+                Event.ADD_REPORT, course=course.name, grade=course.grade,
                 username=user.number, name=user.name, report=form.name.data)
-            log_user(content)
 
             report = Report(
                 course_id=course_id,
@@ -488,56 +424,28 @@ def add_report(course_id):
 @admin_bp.route('manage/report/<int:course_id>/batch', methods=['GET', 'POST'])
 @permission_required('MODERATOR_REPORT')
 def add_report_batch(course_id):
-    from os import path
-    from uuid import uuid4
-
-    import pandas as pd
-
     form = AddReportBatchForm()
     if form.validate_on_submit():
         file = request.files.get('file')
-        path = path.join(
-            current_app.config['FILE_CACHE_PATH'], safe_filename(file.filename))
-        file.save(path)
-        df = pd.read_excel(path)
-
-        if not set(df.columns) >= set(['name', 'number', 'remark']):
-            flash(
-                _("The EXCEL file columns should contain 'name', 'number' and 'remark'."), 'error')
+        course = Course.query.get_or_404(course_id)
+        start = time.time()
+        try:
+            results = import_reports(course, read_rows(file, REPORT_COLUMNS))
+        except SpreadsheetError as e:
+            flash(str(e), 'error')
             return redirect_back()
 
-        course = Course.query.get_or_404(course_id)
-        for i, row in df.iterrows():
-            number = row['number']
-            if isinstance(number, (int, float)):
-                number = str(int(number))
-
-            user = User.query.filter_by(number=number).one()
-            if user:
-                if course.grade == user.grade:
-                    content = render_template(
-                        'logs/admin/add_report.html', course=course.name, grade=course.grade,
-                        username=user.number, name=user.name, report=row['name'])
-                    log_user(content)
-
-                    report = Report(
-                        course_id=course_id,
-                        speaker_id=user.id,
-                        name=row['name'],
-                        remark=row['remark']
-                    )
-                    db.session.add(report)
-                    db.session.commit()
-                else:
-                    flash(
-                        _('The %(speaker)s is not belong to this course.', speaker=user.number), 'error')
-            else:
-                flash(_("%(number)s is not existed.",
-                        number=number), 'error')
-
-        flash_errors(form)
-        flash(_('Add Report success.'), 'success')
-        return redirect_back()
+        created = sum(1 for result in results if result['status'] == 'created')
+        log_user(Event.ADD_REPORT_BATCH, file=file.filename, course=course.name,
+                 grade=course.grade, created=created, failed=len(results) - created)
+
+        metrics.observe('recordit_import_duration_seconds', time.time() - start, kind='reports')
+        metrics.observe('recordit_import_rows', len(results),
+                        buckets=(10, 100, 1000, 10000, 100000), kind='reports')
+
+        flash(_('%(created)d of %(total)d reports added.',
+                created=created, total=len(results)), 'success' if created == len(results) else 'warning')
+        return render_template('admin/add_report_batch.html', form=form, results=results)
 
     return render_template('admin/add_report_batch.html', form=form)
 
@@ -546,10 +454,9 @@ def add_report_batch(course_id):
 @permission_required('MODERATOR_REPORT')
 def delete_report(report_id):
     report = Report.query.get_or_404(report_id)
-    content = render_template(
-        'logs/admin/delete_report.html',
-        grade=report.grade, course=report.course_name, report=report.name)
-    log_user(content)
+    log_user(
+        Event.DELETE_REPORT, grade=report.grade, course=report.course_name,
+        report=report.name)
 
     if current_user.is_teacher:
         if report.teacher_id != current_user.id:
@@ -565,7 +472,7 @@ def delete_report(report_id):
 @admin_bp.route('manage/record-table/<int:report_id>')
 @permission_required('MODERATOR_RECORD_TABLE')
 def manage_record(report_id):
-    log_user(content=render_template('logs/admin/manage_record.html'))
+    log_user(Event.MANAGE_RECORD)
     report = Report.query.get_or_404(report_id)
 
     if current_user.is_teacher:
@@ -574,7 +481,8 @@ def manage_record(report_id):
 
     per_page = current_app.config['MANAGE_RECORD_TABLE_PER_PAGE']
     page = request.args.get('page', 1, type=int)
-    pagination = RecordTable.query.filter_by(report_id=report_id).order_by(
+    pagination = RecordTable.query.options(
+        eager(RecordTable.reviewer)).filter_by(report_id=report_id).order_by(
         RecordTable.time.desc()).paginate(page, per_page)
     form = DeleteRecordForm()
 
@@ -587,8 +495,7 @@ def manage_record(report_id):
 def download_file(file):
     from os import path
 
-    content = render_template('logs/admin/download_file.html', file=file)
-    log_user(content=content)
+    log_user(Event.DOWNLOAD_FILE, file=file)
 
     path = path.join(current_app.config['UPLOAD_PATH'], file)
     return send_file(path)
@@ -597,53 +504,79 @@ def download_file(file):
 @admin_bp.route('manage/record-table/<int:report_id>/download')
 @permission_required('MODERATOR_RECORD_TABLE')
 def download_record(report_id):
-    from os import path
-    from uuid import uuid4
-
-    import pandas as pd
-
     report = Report.query.get(report_id)
-    content = render_template(
-        'logs/admin/download_record.html', report=report.name, username=report.speaker_number)
-    log_user(content=content)
-
-    query = RecordTable.query.filter_by(report_id=report_id)
-    df = pd.read_sql_query(query.statement, db.engine)
-
-    df['grade'] = (
-        df['report_id'].apply(lambda x: Report.query.get(x).grade))
-    df['course_name'] = (
-        df['report_id'].apply(lambda x: Report.query.get(x).course_name))
-    df['report_name'] = (
-        df['report_id'].apply(lambda x: Report.query.get(x).name))
-    df['reviewer_name'] = (
-        df['id'].apply(lambda x: RecordTable.query.get(x).reviewer_name))
-    df['reviewer_number'] = (
-        df['id'].apply(lambda x: RecordTable.query.get(x).reviewer_number))
-    df['speaker_name'] = (
-        df['report_id'].apply(lambda x: Report.query.get(x).speaker_name))
-    df['speaker_number'] = (
-        df['report_id'].apply(lambda x: Report.query.get(x).speaker_number))
-    df['teacher_name'] = (
-        df['report_id'].apply(lambda x: Report.query.get(x).teacher_name))
-    df['teacher_number'] = (
-        df['report_id'].apply(lambda x: Report.query.get(x).teacher_number))
-
-    df.drop(columns=['id', 'report_id', 'user_id'], inplace=True)
-
-    file = path.join(
-        current_app.config['FILE_CACHE_PATH'], uuid4().hex + '.xlsx')
-    df.to_excel(file, index=False)
-
-    zfile = file.replace('.xlsx', '.zip')
-    images = [path.join(current_app.config['UPLOAD_PATH'], rt.file)
-              for rt in report.recordtables if rt.file]
-    packitup(file, zfile, mode='w')
-    packitup(images, zfile, mode='a', diff=True)
+    log_user(
+        Event.DOWNLOAD_RECORD, report=report.name,
+        username=report.speaker_number)
+
+    format = export_format()
+    members = record_members(record_query(report_id=report_id), 'records', format)
+    version = record_version(report_id=report_id)
 
     flash(_('The file is already downloaded.'), 'success')
 
-    return send_file(zfile, as_attachment=True, attachment_filename='records.zip')
+    return cached_zip(export_key('report', report_id, format), version, members, 'records.zip')
+
+
+def export_format():
+    """The spreadsheet format asked for by ``?format=``, xlsx by default."""
+    format = request.args.get('format', DEFAULT_EXPORT_FORMAT)
+    if format not in EXPORT_FORMATS:
+        abort(400)
+    return format
+
+
+def check_export_owner(kind, object_id):
+    if kind == 'course':
+        teacher_id = Course.query.get_or_404(object_id).teacher_id
+    else:
+        teacher_id = Report.query.get_or_404(object_id).teacher_id
+
+    if current_user.is_teacher and teacher_id != current_user.id:
+        abort(403)
+
+
+@admin_bp.route('manage/export/<any(course, report):kind>/<int:object_id>')
+@permission_required('MODERATOR_RECORD_TABLE')
+def export(kind, object_id):
+    check_export_owner(kind, object_id)
+
+    job_id = submit_export(kind, object_id, export_format())
+    return redirect(url_for('.export_job', job_id=job_id))
+
+
+@admin_bp.route('manage/export/job/<string:job_id>')
+@permission_required('MODERATOR_RECORD_TABLE')
+def export_job(job_id):
+    job = parse_export_job_id(job_id)
+    if job is None:
+        abort(404)
+    check_export_owner(*job[:2])
+
+    status = export_status(job_id)
+    if status['status'] == 'finished':
+        status['url'] = url_for('.download_export', job_id=job_id)
+
+    if request.args.get('format') == 'json':
+        return jsonify(status)
+    return render_template('admin/export_job.html', job=status)
+
+
+@admin_bp.route('manage/export/job/<string:job_id>/download')
+@permission_required('MODERATOR_RECORD_TABLE')
+def download_export(job_id):
+    job = parse_export_job_id(job_id)
+    if job is None:
+        abort(404)
+    kind, object_id, format, version = job
+    check_export_owner(kind, object_id)
+
+    status = export_status(job_id)
+    if status['status'] != 'finished':
+        abort(404)
+
+    file = export_file(export_key(kind, object_id, format), version)
+    return send_file(file, as_attachment=True, attachment_filename=status['filename'])
 
 
 @admin_bp.route('manage/record-table/<int:record_id>', methods=['POST'])
@@ -651,16 +584,17 @@ def download_record(report_id):
 def delete_record(record_id):
     record = RecordTable.query.get_or_404(record_id)
 
-    content = render_template(
-        'logs/admin/delete_record.html', username=record.reviewer_number,
+    log_user(
+        Event.DELETE_RECORD, username=record.reviewer_number,
         name=record.reviewer_name, report=record.report_name)
-    log_user(content)
 
     if current_user.is_teacher:
         if record.teacher_id != current_user.id:
             abort(403)
 
     db.session.delete(record)
+    Report.update_score(
+        record.report_id, old=record.score, by_student=record.reviewer.is_student)
     db.session.commit()
 
     flash(_('Record Table deleted.'), 'info')
@@ -671,41 +605,76 @@ def delete_record(record_id):
 @permission_required('ADMINISTER')
 def system_log():
     from os import path
-    from uuid import uuid4
 
-    log_user(content=render_template('logs/admin/system_log.html'))
+    log_user(Event.SYSTEM_LOG)
 
-    file = path.join(
-        current_app.config['FILE_CACHE_PATH'], uuid4().hex + '.zip')
-    packitup(current_app.config['SYSTEM_LOG_PATH'], file)
+    file = current_app.config['SYSTEM_LOG_PATH']
+    if not path.isfile(file):
+        abort(404)
 
     flash(_('System logs dowdloaded.'), 'info')
 
-    return send_file(file, as_attachment=True, attachment_filename='system logs.zip')
+    return send_zip([(path.basename(file), file)], 'system logs.zip')
 
 
 @admin_bp.route('manage/logs/user')
 @permission_required('ADMINISTER')
 def user_log():
-    from os import path
-    from uuid import uuid4
+    from datetime import datetime
+
+    log_user(Event.USER_LOG)
+
+    filters = {}
+    try:
+        for name in ('start', 'end'):
+            if request.args.get(name):
+                filters[name] = datetime.strptime(request.args[name], '%Y-%m-%d')
+    except ValueError:
+        abort(400)
+    filters['number'] = request.args.get('number') or None
+    filters['role'] = request.args.get('role') or None
+    filters['event'] = request.args.get('event', type=int)
+
+    # 'YYYY-MM' exports a month that was already moved to the log archive
+    month = request.args.get('month')
+    if month:
+        if month not in archived_months():
+            abort(404)
+        members = archived_log_members(month, 'user logs %s.csv' % month, **filters)
+    else:
+        members = log_members('user logs.csv', **filters)
 
-    import pandas as pd
+    flash(_('User logs dowdloaded.'), 'info')
 
-    log_user(content=render_template('logs/admin/user_log.html'))
+    return send_zip(members, 'user logs.zip')
 
-    df = pd.read_sql_query(Log.query.statement, db.engine)
-    df['number'] = df['user_id'].apply(lambda x: User.query.get(x).number)
-    df['role'] = df['user_id'].apply(lambda x: User.query.get(x).role.name)
 
-    df.drop(columns=['id', 'user_id'], inplace=True)
+@admin_bp.route('manage/logs/sql')
+@permission_required('ADMINISTER')
+def sql_stats():
+    return render_template('admin/sql_stats.html', endpoints=sqlstats.endpoints(),
+                           slow_queries=sqlstats.slow_queries())
 
-    file = path.join(
-        current_app.config['FILE_CACHE_PATH'], uuid4().hex + '.xlsx')
-    zfile = file.replace('.xlsx', '.zip')
-    df.to_excel(file, index=False)
-    packitup(file, zfile)
 
-    flash(_('User logs dowdloaded.'), 'info')
+@admin_bp.route('manage/logs/profiles')
+@permission_required('ADMINISTER')
+def profiles():
+    return render_template('admin/profiles.html', profiles=profiler.profiles())
 
-    return send_file(zfile, as_attachment=True, attachment_filename='user logs.zip')
+
+@admin_bp.route('manage/logs/profiles/<string:profile_id>.<any(prof, json):kind>')
+@permission_required('ADMINISTER')
+def download_profile(profile_id, kind):
+    from os import path
+
+    file = profile_file(profile_id, kind)
+    if file is None or not path.isfile(file):
+        abort(404)
+    return send_file(file, as_attachment=True)
+
+
+@admin_bp.route('metrics')
+@permission_required('ADMINISTER')
+def prometheus_metrics():
+    return current_app.response_class(
+        metrics.render(), mimetype='text/plain; version=0.0.4')
@@ -5,6 +5,7 @@ from flask_babel import _
 from flask_login import (confirm_login, current_user, login_fresh,
                          login_required, login_user, logout_user)
 
+from recordit.audit import Event
 from recordit.forms.auth import LoginForm
 from recordit.models import User
 from recordit.utils import log_user, redirect_back
@@ -22,7 +23,7 @@ def login():
         user = User.query.filter_by(number=form.username.data).first()
         if user is not None and user.validate_password(form.password.data):
             if login_user(user, form.remember_me.data):
-                log_user(content=render_template('logs/auth/login.html'))
+                log_user(Event.LOGIN)
 
                 flash(_('Login success.'), 'info')
                 return redirect(url_for('user.index'))
@@ -35,7 +36,7 @@ def login():
 @auth_bp.route('/logout')
 @login_required
 def logout():
-    log_user(content=render_template('logs/auth/logout.html'))
+    log_user(Event.LOGOUT)
 
     logout_user()
     flash(_('Logout success.'), 'info')
@@ -52,7 +53,7 @@ def re_authenticate():
     form = LoginForm()
     if form.validate_on_submit() and current_user.validate_password(form.password.data):
         confirm_login()
-        log_user(content=render_template('logs/auth/login.html'))
+        log_user(Event.LOGIN)
 
         return redirect_back()
 
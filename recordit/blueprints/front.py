@@ -6,7 +6,7 @@ from flask_babel import _
 from flask_login import current_user
 
 from recordit.extensions import cache, db
-from recordit.models import Course, Report, Role, User
+from recordit.models import Course, Report, User, role_registry
 from recordit.utils import redirect_back
 
 front_bp = Blueprint('front', __name__)
@@ -24,10 +24,10 @@ def index():
 @front_bp.route('/about')
 @cache.cached(timeout=60)
 def about():
-    role_teacher = Role.query.filter_by(name='Teacher').one()
-    teacher_count = User.query.filter_by(role_id=role_teacher.id).count()
-    role_student = Role.query.filter_by(name='Student').one()
-    student_count = User.query.filter_by(role_id=role_student.id).count()
+    teacher_count = User.query.filter_by(
+        role_id=role_registry.id('Teacher')).count()
+    student_count = User.query.filter_by(
+        role_id=role_registry.id('Student')).count()
 
     course_count = Course.query.count()
     report_count = Report.query.count()
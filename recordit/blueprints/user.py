@@ -5,11 +5,12 @@ from flask import (Blueprint, abort, current_app, flash, redirect,
 from flask_babel import _
 from flask_login import current_user, fresh_login_required, login_required
 
+from recordit.audit import Event
 from recordit.decorators import permission_required
 from recordit.extensions import db
 from recordit.forms.user import (ChangePasswordForm, EditAdministratorForm,
                                  EditStudenteForm, EditTeacherForm, ReviewForm)
-from recordit.models import Course, RecordTable, Report, User
+from recordit.models import Course, RecordTable, Report, User, eager
 from recordit.utils import allowed_file, gen_uuid, log_user, redirect_back
 
 user_bp = Blueprint('user', __name__)
@@ -24,15 +25,16 @@ def login_protect():
 @user_bp.route('/')
 def index():
     page = request.args.get('page', 1, type=int)
+    query = Report.query.options(eager(Report.speaker))
     if current_user.is_admin:
-        pagination = Report.query.filter_by(active=True).join(Course).filter(Course.active).order_by(
+        pagination = query.filter_by(active=True).join(Course).filter(Course.active).order_by(
             Report.date).paginate(page, current_app.config['USER_REPORT_PER_PAGE'])
     elif current_user.is_teacher:
-        pagination = Report.query.filter_by(active=True).join(Course).filter(
+        pagination = query.filter_by(active=True).join(Course).filter(
             Course.teacher_id == current_user.id, Course.active).order_by(
             Report.date).paginate(page, current_app.config['USER_REPORT_PER_PAGE'])
     else:
-        pagination = Report.query.filter(Report.active, Report.speaker_id != current_user.id).join(Course).filter(
+        pagination = query.filter(Report.active, Report.speaker_id != current_user.id).join(Course).filter(
             Course.grade == current_user.grade, Course.active).order_by(
             Report.date).paginate(page, current_app.config['USER_REPORT_PER_PAGE'])
 
@@ -56,10 +58,10 @@ def review(report_id):
         if form.validate_on_submit():
             from os import path
 
-            content = render_template(
-                'logs/user/reivew.html', course=report.course_name,
-                number=report.speaker_number, name=report.speaker_name, report=report.name)
-            log_user(content=content)
+            log_user(
+                Event.REVIEW, course=report.course_name,
+                number=report.speaker_number, name=report.speaker_name,
+                report=report.name)
 
             upper = current_app.config['RECORD_TABLE_UPPER_LIMIT']
             lower = current_app.config['RECORD_TABLE_LOWER_LIMIT']
@@ -84,11 +86,16 @@ def review(report_id):
                     file=filename
                 )
                 db.session.add(record)
+                Report.update_score(
+                    report.id, new=record.score, by_student=current_user.is_student)
             else:
+                old_score = record.score
                 record.score = form.score.data
                 record.remark = form.remark.data
                 if file:
                     record.file = filename
+                Report.update_score(
+                    report.id, old=old_score, new=record.score, by_student=current_user.is_student)
 
             db.session.commit()
             flash(_('Reviewed success.'), 'success')
@@ -117,8 +124,7 @@ def edit_profile():
         form = EditStudenteForm()
 
     if form.validate_on_submit():
-        log_user(
-            content=render_template('logs/user/settings/edit_profile.html'))
+        log_user(Event.EDIT_OWN_PROFILE)
 
         current_user.remark = form.remark.data
         db.session.commit()
@@ -138,8 +144,7 @@ def edit_profile():
 def change_password():
     form = ChangePasswordForm()
     if form.validate_on_submit():
-        log_user(
-            content=render_template('logs/user/settings/change_password.html'))
+        log_user(Event.CHANGE_OWN_PASSWORD)
 
         current_user.set_password(form.password.data)
         db.session.commit()
@@ -0,0 +1,539 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import io
+import json
+import os
+import tempfile
+import time
+from hashlib import sha1
+from importlib.util import find_spec
+from os import path
+from uuid import uuid4
+
+from flask import current_app, send_file
+from sqlalchemy import func
+from sqlalchemy.orm import aliased
+
+from recordit.audit import Event, read_archive
+from recordit.extensions import db, scheduler
+from recordit.metrics import metrics
+from recordit.models import Course, Log, RecordTable, Report, Role, User
+from recordit.utils import ZipBuffer, send_stream, zipstream
+
+
+def record_query(course_id=None, report_id=None):
+    """Select every exported record table column in one joined statement.
+
+    Each row carries its report, course, speaker, reviewer and teacher
+    columns, so the export never goes back to the ORM per row.
+    """
+    speaker = aliased(User)
+    reviewer = aliased(User)
+    teacher = aliased(User)
+
+    query = db.session.query(
+        RecordTable.score,
+        RecordTable.file,
+        RecordTable.time,
+        RecordTable.remark,
+        Course.grade.label('grade'),
+        Course.name.label('course_name'),
+        Report.name.label('report_name'),
+        speaker.name.label('speaker_name'),
+        speaker.number.label('speaker_number'),
+        reviewer.name.label('reviewer_name'),
+        reviewer.number.label('reviewer_number'),
+        teacher.name.label('teacher_name'),
+        teacher.number.label('teacher_number')
+    ).select_from(RecordTable).join(
+        Report, RecordTable.report_id == Report.id).join(
+        Course, Report.course_id == Course.id).outerjoin(
+        speaker, Report.speaker_id == speaker.id).outerjoin(
+        reviewer, RecordTable.user_id == reviewer.id).outerjoin(
+        teacher, Course.teacher_id == teacher.id)
+
+    query = filter_records(query, course_id, report_id)
+
+    return query.order_by(Report.id, RecordTable.time)
+
+
+def filter_records(query, course_id=None, report_id=None):
+    if course_id is not None:
+        query = query.filter(Report.course_id == course_id)
+    if report_id is not None:
+        query = query.filter(RecordTable.report_id == report_id)
+    return query
+
+
+def record_version(course_id=None, report_id=None):
+    """Cheap stamp of the records an export would contain.
+
+    It is taken from the count and highest id of the record tables and, per
+    exported report, its name, course and ``Report.version``, which every
+    review, re-review, deletion and rename of a person shown in the export
+    bumps. Only one row per report is read, never the record tables.
+    """
+    records = db.session.query(
+        func.count(RecordTable.id), func.max(RecordTable.id)
+    ).select_from(RecordTable).join(Report, RecordTable.report_id == Report.id)
+    records = filter_records(records, course_id, report_id).one()
+
+    reports = db.session.query(
+        Report.id, Report.version, Report.name, Report.speaker_id,
+        Course.name, Course.grade, Course.teacher_id
+    ).join(Course, Report.course_id == Course.id)
+    if course_id is not None:
+        reports = reports.filter(Report.course_id == course_id)
+    if report_id is not None:
+        reports = reports.filter(Report.id == report_id)
+    reports = reports.order_by(Report.id).all()
+
+    stamp = repr((tuple(records), [tuple(report) for report in reports]))
+    return sha1(stamp.encode('utf-8')).hexdigest()[:16]
+
+
+def log_query(start=None, end=None, number=None, role=None, event=None):
+    """Select the exported user log columns, joined to the user and role.
+
+    ``start`` and ``end`` bound ``Log.time``, ``number`` and ``role`` pick the
+    logs of one user or one role, ``event`` one kind of action.
+    """
+    query = db.session.query(
+        Log.id, Log.ip, Log.time, Log.event, Log.params, Log.content,
+        User.number.label('number'), Role.name.label('role')
+    ).select_from(Log).outerjoin(User, Log.user_id == User.id).outerjoin(
+        Role, User.role_id == Role.id)
+
+    if start is not None:
+        query = query.filter(Log.time >= start)
+    if end is not None:
+        query = query.filter(Log.time < end)
+    if number is not None:
+        query = query.filter(User.number == number)
+    if role is not None:
+        query = query.filter(Role.name == role)
+    if event is not None:
+        query = query.filter(Log.event == event)
+    return query
+
+
+def iter_chunks(query, column, size=5000):
+    """Yield the rows of ``query`` in lists of ``size``.
+
+    Pages are taken by keyset on the unique, ordered ``column`` which must be
+    the first selected column, so every chunk is an index range scan and no
+    more than one chunk is held in memory.
+    """
+    last = None
+    while True:
+        page = query
+        if last is not None:
+            page = page.filter(column > last)
+        rows = page.order_by(column).limit(size).all()
+        if not rows:
+            break
+        yield rows
+        last = rows[-1][0]
+
+
+def csv_chunks(header, chunks):
+    """Encode ``header`` and the row ``chunks`` as UTF-8 CSV, one chunk at a time.
+
+    A byte order mark is written first so Excel detects the encoding.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    yield u'\ufeff'.encode('utf-8') + buffer.getvalue().encode('utf-8')
+
+    for rows in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows)
+        yield buffer.getvalue().encode('utf-8')
+
+
+LOG_HEADER = ['ip', 'time', 'event', 'content', 'number', 'role']
+
+
+def log_members(name, **filters):
+    """Archive member of a user log export, written as CSV chunk by chunk."""
+    chunks = ([(row.ip, row.time, row.event,
+                Event.render(row.event, row.params, row.content),
+                row.number, row.role) for row in rows]
+              for rows in iter_chunks(log_query(**filters), Log.id))
+    yield name, csv_chunks(LOG_HEADER, chunks)
+
+
+def archived_log_members(month, name, size=5000, **filters):
+    """Like ``log_members``, for the logs archived in ``month``."""
+    def chunks():
+        rows = []
+        for row in read_archive(month, **filters):
+            rows.append((row['ip'], row['time'], row['event'],
+                         Event.render(row['event'], row['params'], row['content']),
+                         row['number'], row['role']))
+            if len(rows) == size:
+                yield rows
+                rows = []
+        if rows:
+            yield rows
+
+    yield name, csv_chunks(LOG_HEADER, chunks())
+
+
+def row_chunks(query, size=5000):
+    """Yield the rows of ``query`` in lists of ``size``, straight from the cursor.
+
+    Unlike ``iter_chunks`` it runs one statement, so it suits queries without
+    a unique first column; rows are plain tuples, not ORM objects.
+    """
+    result = db.session.execute(query.statement)
+    try:
+        while True:
+            rows = result.fetchmany(size)
+            if not rows:
+                break
+            yield [tuple(row) for row in rows]
+    finally:
+        result.close()
+
+
+def xlsx_chunks(header, chunks, chunk_size=64 * 1024):
+    """Write ``header`` and the row ``chunks`` as an xlsx workbook.
+
+    openpyxl's write-only mode spools the sheet to a temporary file as rows
+    come in; the finished workbook is then read back ``chunk_size`` bytes
+    at a time.
+    """
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(header)
+    for rows in chunks:
+        for row in rows:
+            sheet.append(row)
+
+    with tempfile.TemporaryFile() as f:
+        workbook.save(f)
+        f.seek(0)
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            yield chunk
+
+
+class ParquetBuffer(ZipBuffer):
+    """``ZipBuffer`` that also tells its position, which pyarrow asks for."""
+
+    closed = False
+
+    def __init__(self):
+        super(ParquetBuffer, self).__init__()
+        self.position = 0
+
+    def write(self, data):
+        self.position += len(data)
+        return super(ParquetBuffer, self).write(data)
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.closed = True
+
+
+def parquet_chunks(header, chunks):
+    """Write ``header`` and the row ``chunks`` as Parquet, one row group per chunk.
+
+    Column types are inferred from the first chunk; a column that is empty
+    throughout it is written as text.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    buffer = ParquetBuffer()
+    writer = None
+    for rows in chunks:
+        table = pa.Table.from_arrays(
+            [pa.array(list(column)) for column in zip(*rows)], names=header)
+        if writer is None:
+            schema = pa.schema([
+                pa.field(field.name, pa.string() if pa.types.is_null(field.type) else field.type)
+                for field in table.schema])
+            writer = pq.ParquetWriter(buffer, schema)
+        writer.write_table(table.cast(schema))
+        yield buffer.drain()
+
+    if writer is None:
+        writer = pq.ParquetWriter(buffer, pa.schema([pa.field(name, pa.string()) for name in header]))
+    writer.close()
+    yield buffer.drain()
+
+
+# format -> writer taking a header and row chunks and yielding bytes
+EXPORT_FORMATS = {
+    'xlsx': xlsx_chunks,
+    'csv': csv_chunks,
+}
+# the columnar format is there when pyarrow is installed
+if find_spec('pyarrow') is not None:
+    EXPORT_FORMATS['parquet'] = parquet_chunks
+
+DEFAULT_EXPORT_FORMAT = 'xlsx'
+
+
+def upload_members(files):
+    """Pair each uploaded file name with its archive name and path."""
+    upload_path = current_app.config['UPLOAD_PATH']
+    folder = path.basename(upload_path)
+    for file in files:
+        yield path.join(folder, file), path.join(upload_path, file)
+
+
+def record_members(query, name, format=DEFAULT_EXPORT_FORMAT, progress=None):
+    """Archive members of a record export: the spreadsheet, then its uploads.
+
+    Rows go from the cursor to the ``format`` writer chunk by chunk, picking
+    up the attached file names on the way. ``progress`` is called with the
+    number of uploads archived and their total after each one.
+    """
+    header = [column['name'] for column in query.column_descriptions]
+    file = header.index('file')
+    files = []
+
+    def chunks():
+        for rows in row_chunks(query):
+            files.extend(row[file] for row in rows if row[file])
+            yield rows
+
+    yield '%s.%s' % (name, format), EXPORT_FORMATS[format](header, chunks())
+
+    members = list(upload_members(files))
+    for i, member in enumerate(members, 1):
+        yield member
+        if progress is not None:
+            progress(i, len(members))
+
+
+def export_file(key, version):
+    return path.join(
+        current_app.config['EXPORT_CACHE_PATH'], '%s-%s.zip' % (key, version))
+
+
+def status_file(job_id):
+    return path.join(current_app.config['EXPORT_CACHE_PATH'], job_id + '.json')
+
+
+def store_export(key, version, chunks):
+    """Pass ``chunks`` through while writing them to the export cache.
+
+    The archive only becomes visible under its final name once complete;
+    other versions of ``key`` are dropped at that point.
+    """
+    cache_path = current_app.config['EXPORT_CACHE_PATH']
+    file = export_file(key, version)
+    if not path.isdir(cache_path):
+        os.makedirs(cache_path)
+
+    temp = path.join(cache_path, '.%s.part' % uuid4().hex)
+    start = time.time()
+    try:
+        with open(temp, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        os.replace(temp, file)
+        kind, _, format = key.split('-')
+        metrics.observe('recordit_export_duration_seconds', time.time() - start,
+                        kind=kind, format=format)
+    finally:
+        if path.exists(temp):
+            os.remove(temp)
+
+    # only the archives of other versions; status files and the .part files
+    # of builds still running in other workers stay
+    for name in os.listdir(cache_path):
+        if (name.startswith(key + '-') and name.endswith('.zip')
+                and name != path.basename(file)):
+            try:
+                os.remove(path.join(cache_path, name))
+            except FileNotFoundError:
+                pass
+    evict_exports()
+
+
+def cached_zip(key, version, members, filename):
+    """Send the archive ``key`` at ``version``, building it only when missing.
+
+    A fresh build is streamed to the client and stored at the same time.
+    """
+    file = export_file(key, version)
+    if path.isfile(file):
+        metrics.inc('recordit_export_cache_total', result='hit')
+        os.utime(file, None)
+        return send_file(file, as_attachment=True, attachment_filename=filename)
+
+    metrics.inc('recordit_export_cache_total', result='miss')
+    return send_stream(store_export(key, version, zipstream(members)), filename)
+
+
+# kind -> (record_query/record_version keyword, spreadsheet and archive name)
+EXPORT_KINDS = {
+    'course': ('course_id', 'reports'),
+    'report': ('report_id', 'records'),
+}
+
+
+def export_key(kind, object_id, format):
+    """Cache key of the ``format`` archive of ``kind`` ``object_id``."""
+    return '%s-%d-%s' % (kind, object_id, format)
+
+
+def export_job_id(kind, object_id, format=DEFAULT_EXPORT_FORMAT):
+    """Id of the export job for the current content of ``kind`` ``object_id``.
+
+    Requests for unchanged data in the same format map to the same id, which
+    is how duplicate submissions are coalesced into one job.
+    """
+    keyword = EXPORT_KINDS[kind][0]
+    version = record_version(**{keyword: object_id})
+    return '%s-%s' % (export_key(kind, object_id, format), version)
+
+
+def parse_export_job_id(job_id):
+    """Split a job id back into ``(kind, object_id, format, version)``."""
+    try:
+        kind, object_id, format, version = job_id.split('-')
+        object_id = int(object_id)
+    except ValueError:
+        return None
+    if kind not in EXPORT_KINDS or format not in EXPORT_FORMATS:
+        return None
+    return kind, object_id, format, version
+
+
+def export_status(job_id):
+    """Current state of ``job_id``, shared by every worker process.
+
+    The state lives in a small JSON file next to the archive; a finished job
+    is simply one whose archive exists in the cache.
+    """
+    kind, object_id, format, version = parse_export_job_id(job_id)
+    status = {'id': job_id, 'status': 'missing', 'progress': 0.0,
+              'filename': EXPORT_KINDS[kind][1] + '.zip'}
+
+    if path.isfile(export_file(export_key(kind, object_id, format), version)):
+        status.update(status='finished', progress=1.0)
+        return status
+
+    try:
+        with open(status_file(job_id)) as f:
+            status.update(json.load(f))
+    except (IOError, ValueError):
+        pass
+    return status
+
+
+def set_export_status(job_id, **status):
+    file = status_file(job_id)
+    status['updated'] = time.time()
+    temp = file + '.' + uuid4().hex
+    with open(temp, 'w') as f:
+        json.dump(status, f)
+    os.replace(temp, file)
+
+
+def submit_export(kind, object_id, format=DEFAULT_EXPORT_FORMAT):
+    """Queue a ``format`` export of ``kind`` ``object_id`` unless it already exists.
+
+    Jobs run on the scheduler's bounded ``exports`` executor. A job that is
+    queued or running in any worker process is reused rather than started
+    again, unless it has not reported progress for ``EXPORT_JOB_TIMEOUT``.
+    """
+    from apscheduler.jobstores.base import ConflictingIdError
+
+    job_id = export_job_id(kind, object_id, format)
+    status = export_status(job_id)
+    if status['status'] == 'finished':
+        metrics.inc('recordit_export_cache_total', result='hit')
+        return job_id
+    metrics.inc('recordit_export_cache_total', result='miss')
+
+    timeout = current_app.config['EXPORT_JOB_TIMEOUT']
+    if status['status'] in ('queued', 'running') and time.time() - status['updated'] < timeout:
+        return job_id
+
+    cache_path = current_app.config['EXPORT_CACHE_PATH']
+    if not path.isdir(cache_path):
+        os.makedirs(cache_path)
+    set_export_status(job_id, status='queued', progress=0.0)
+
+    try:
+        scheduler.add_job(
+            job_id, run_export, args=(job_id,), executor='exports',
+            misfire_grace_time=None)
+    except ConflictingIdError:
+        pass
+    return job_id
+
+
+def run_export(job_id):
+    """Build the archive of ``job_id`` in the background, reporting progress."""
+    with scheduler.app.app_context():
+        kind, object_id, format, version = parse_export_job_id(job_id)
+        keyword, name = EXPORT_KINDS[kind]
+        set_export_status(job_id, status='running', progress=0.0)
+
+        def progress(done, total):
+            # the spreadsheet counts as one more member
+            if done % 20 == 0:
+                set_export_status(
+                    job_id, status='running', progress=float(done + 1) / (total + 1))
+
+        try:
+            members = record_members(
+                record_query(**{keyword: object_id}), name, format, progress)
+            key = export_key(kind, object_id, format)
+            for _ in store_export(key, version, zipstream(members)):
+                pass
+        except Exception:
+            current_app.logger.exception('Export %s failed.', job_id)
+            set_export_status(job_id, status='failed', progress=0.0)
+        finally:
+            db.session.remove()
+
+
+def evict_exports():
+    """Drop cached archives older than ``EXPORT_CACHE_MAX_AGE`` seconds, then
+    the least recently used ones until the cache fits ``EXPORT_CACHE_MAX_SIZE``.
+    """
+    cache_path = current_app.config['EXPORT_CACHE_PATH']
+    if not path.isdir(cache_path):
+        return
+
+    now = time.time()
+    files = []
+    # another worker may be evicting at the same time, so files can vanish
+    for name in os.listdir(cache_path):
+        file = path.join(cache_path, name)
+        try:
+            if name.startswith('.') or not path.isfile(file):
+                continue
+            stat = os.stat(file)
+            if now - stat.st_mtime > current_app.config['EXPORT_CACHE_MAX_AGE']:
+                os.remove(file)
+            else:
+                files.append((stat.st_mtime, stat.st_size, file))
+        except FileNotFoundError:
+            pass
+
+    size = sum(item[1] for item in files)
+    for _, file_size, file in sorted(files):
+        if size <= current_app.config['EXPORT_CACHE_MAX_SIZE']:
+            break
+        try:
+            os.remove(file)
+        except FileNotFoundError:
+            pass
+        size -= file_size
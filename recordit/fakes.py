@@ -1,13 +1,45 @@
 # -*- coding: utf-8 -*-
 
+import datetime
+import random
+
 from faker import Faker
 from flask import current_app
-from sqlalchemy.sql.expression import func
 
 from recordit import db
-from recordit.models import Course, RecordTable, Report, Role, User
+from recordit.models import Course, RecordTable, Report, User, role_registry
+from recordit.passwords import hash_password
 
 fake = Faker('zh_CN')
+rng = random.Random()
+
+# sizes at scale 1; students and courses are per grade
+SCALE = {
+    'grades': 4,
+    'students': 50,
+    'teachers': 6,
+    'courses': 2,
+}
+
+# how many reports a student gives in a term, and how likely each is
+REPORTS_PER_STUDENT = ((0, 0.15), (1, 0.6), (2, 0.2), (3, 0.05))
+
+BATCH_SIZE = 5000
+
+# the term of the fake data, fixed so a seed gives the same data in any year
+YEAR = 2019
+
+
+def bulk_insert(table, rows, size=BATCH_SIZE):
+    """Insert ``rows`` into ``table`` in executemany batches of ``size``."""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            db.session.execute(table.insert(), batch)
+            batch = []
+    if batch:
+        db.session.execute(table.insert(), batch)
 
 
 def fake_admin():
@@ -22,102 +54,204 @@ def fake_admin():
     db.session.commit()
 
 
-def fake_teacher(count=1):
-    for i in range(count):
-        print(i)
-        user = User(
-            name=fake.name(),
-            number=str(fake.random_number(digits=4, fix_len=True)),
-            remark=fake.text(),
-        )
-        user.set_password(current_app.config['ADMIN_PASSWORD'])
-        user.set_role('Teacher')
-
-        db.session.add(user)
-        try:
-            db.session.commit()
-        except:
-            db.session.rollback()
-
-
-def fake_student(count=50, grade='2016'):
-    for i in range(count):
-        print(i)
-        number = grade + str(fake.random_number(digits=8, fix_len=True))
-        user = User(
-            name=fake.name(),
-            number=number,
-            remark=fake.text(),
-        )
-        user.set_password(current_app.config['ADMIN_PASSWORD'])
-
-        db.session.add(user)
-        try:
-            db.session.commit()
-        except:
-            db.session.rollback()
-
-
-def fake_course(count=1):
-    role_teacher = Role.query.filter_by(name='Teacher').first()
-    role_student = Role.query.filter_by(name='Student').first()
-    for i in range(count):
-        print(i)
-        teacher = User.query.filter_by(
-            role_id=role_teacher.id).order_by(func.random()).first()
-        student = User.query.filter_by(
-            role_id=role_student.id).order_by(func.random()).first()
-        course = Course(
-            teacher_id=teacher.id,
-            name=fake.text(max_nb_chars=10),
-            grade=student.grade,
-            remark=fake.text()
-        )
-        db.session.add(course)
-        try:
-            db.session.commit()
-        except:
-            db.session.rollback()
-
-
-def fake_report(count=3):
-    role = Role.query.filter_by(name='Student').first()
-    for i in range(count):
-        print(i)
-        user = User.query.filter_by(
-            role_id=role.id).order_by(func.random()).first()
-        course = Course.query.filter_by(grade=user.grade).order_by(func.random()).first()
-        if course:
-            report = Report(
-                course_id=course.id,
-                speaker_id=user.id,
-                name=fake.text(max_nb_chars=10),
-                remark=fake.text()
-            )
-
-            db.session.add(report)
-            try:
-                db.session.commit()
-            except:
-                db.session.rollback()
-
-
-def fake_record(count=10):
-    for i in range(count):
-        print(i)
-        user = User.query.order_by(func.random()).first()
-        report = Report.query.filter(
-            Report.speaker_id != user.id).order_by(func.random()).first()
-        if report:
-            record = RecordTable(
-                report_id=report.id,
-                user_id=user.id,
-                score=fake.random_int(min=0, max=100),
-                remark=fake.text()
-            )
-
-            db.session.add(record)
-            try:
-                db.session.commit()
-            except:
-                db.session.rollback()
+def fake_teacher(count, password_hash, remarks):
+    """Insert ``count`` teachers, returning their ids."""
+    numbers = [str(1000 + i) for i in range(count)]
+    bulk_insert(User.__table__, ({
+        'name': fake.name(),
+        'number': number,
+        'password_hash': password_hash,
+        'remark': rng.choice(remarks),
+        'locale': 'zh_Hans_CN',
+        'role_id': role_registry.id('Teacher'),
+    } for number in numbers))
+
+    return [id for id, in db.session.query(User.id).filter(User.number.in_(numbers))]
+
+
+def fake_student(count, grade, password_hash, remarks):
+    """Insert ``count`` students of ``grade``, returning their ids."""
+    numbers = ['%s%08d' % (grade, n) for n in sorted(rng.sample(range(10 ** 8), count))]
+    bulk_insert(User.__table__, ({
+        'name': fake.name(),
+        'number': number,
+        'password_hash': password_hash,
+        'remark': rng.choice(remarks),
+        'locale': 'zh_Hans_CN',
+        'role_id': role_registry.id('Student'),
+    } for number in numbers))
+
+    return [id for id, in db.session.query(User.id).filter(
+        User.number.like(grade + '%'), User.role_id == role_registry.id('Student'))]
+
+
+def fake_course(grades, count, teachers, remarks, term_start):
+    """Insert ``count`` courses per grade.
+
+    A few teachers take most of the courses. Returns the courses as
+    ``(id, grade, date)``.
+    """
+    weights = [rng.paretovariate(2) for _ in teachers]
+    bulk_insert(Course.__table__, ({
+        'teacher_id': rng.choices(teachers, weights)[0],
+        'name': fake.text(max_nb_chars=10),
+        'grade': grade,
+        'active': rng.random() < 0.9,
+        'date': term_start + datetime.timedelta(days=rng.randint(0, 14)),
+        'remark': rng.choice(remarks),
+    } for grade in grades for _ in range(count)))
+
+    return db.session.query(Course.id, Course.grade, Course.date).order_by(Course.id).all()
+
+
+def fake_report(courses, students, remarks):
+    """Let every student give 0 to 3 reports in the courses of their grade.
+
+    ``students`` maps each grade to its student ids. Returns the reports as
+    ``(id, course_id, speaker_id, date)``.
+    """
+    by_grade = {}
+    for course in courses:
+        by_grade.setdefault(course.grade, []).append(course)
+
+    counts, weights = zip(*REPORTS_PER_STUDENT)
+
+    def rows():
+        for grade, ids in students.items():
+            for speaker_id in ids:
+                for course in rng.sample(by_grade[grade], min(
+                        rng.choices(counts, weights)[0], len(by_grade[grade]))):
+                    yield {
+                        'course_id': course.id,
+                        'speaker_id': speaker_id,
+                        'name': fake.text(max_nb_chars=10),
+                        'active': rng.random() < 0.95,
+                        'date': course.date + datetime.timedelta(days=rng.randint(0, 120)),
+                        'remark': rng.choice(remarks),
+                    }
+
+    bulk_insert(Report.__table__, rows())
+    return db.session.query(
+        Report.id, Report.course_id, Report.speaker_id, Report.date).order_by(Report.id).all()
+
+
+def fake_record(reports, courses, students, remarks):
+    """Review every report by part of its grade and, usually, its teacher.
+
+    An audience of 20 to 60 students attends, most of whom score the report
+    within two minutes of its end. Scores cluster around a per-report
+    quality. The score aggregates of the reports are filled in as well.
+    Returns the number of record tables.
+    """
+    courses = dict((course.id, course) for course in courses)
+    teachers = dict(db.session.query(Course.id, Course.teacher_id))
+    aggregates = []
+
+    def rows():
+        for report in reports:
+            course = courses[report.course_id]
+            grade = students[course.grade]
+            audience = min(len(grade), rng.randint(20, 60))
+            reviewers = [id for id in rng.sample(grade, audience) if id != report.speaker_id]
+            reviewers = reviewers[:int(len(reviewers) * rng.uniform(0.5, 0.95))]
+            end = datetime.datetime.combine(report.date, datetime.time(rng.randint(8, 17)))
+
+            quality = rng.gauss(80, 8)
+            scores = []
+            for user_id in reviewers:
+                score = float(max(0, min(100, int(rng.gauss(quality, 8)))))
+                scores.append(score)
+                yield record_row(report.id, user_id, score, end, remarks)
+
+            student_count = len(scores)
+            if rng.random() < 0.9:
+                score = float(max(0, min(100, int(rng.gauss(quality, 5)))))
+                scores.append(score)
+                yield record_row(report.id, teachers[report.course_id], score, end, remarks)
+
+            aggregates.append(aggregate(report.id, scores, student_count))
+
+    bulk_insert(RecordTable.__table__, rows())
+
+    table = Report.__table__
+    statement = table.update().where(table.c.id == db.bindparam('report_id'))
+    for i in range(0, len(aggregates), BATCH_SIZE):
+        db.session.execute(statement, aggregates[i:i + BATCH_SIZE])
+
+    return sum(row['score_count'] for row in aggregates)
+
+
+def record_row(report_id, user_id, score, end, remarks):
+    return {
+        'report_id': report_id,
+        'user_id': user_id,
+        'score': score,
+        'time': end + datetime.timedelta(seconds=abs(rng.gauss(0, 45))),
+        'remark': rng.choice(remarks),
+    }
+
+
+def aggregate(report_id, scores, student_count):
+    """The ``Report`` score columns for ``scores``, students' scores first."""
+    students = scores[:student_count]
+    teachers = scores[student_count:]
+    return {
+        'report_id': report_id,
+        'score': sum(scores) / len(scores) if scores else None,
+        'score_count': len(scores),
+        'score_sum': sum(scores),
+        'score_squares': sum(score ** 2 for score in scores),
+        'score_min': min(scores) if scores else None,
+        'score_max': max(scores) if scores else None,
+        'student_count': len(students),
+        'student_sum': sum(students),
+        'teacher_count': len(teachers),
+        'teacher_sum': sum(teachers),
+    }
+
+
+def forge(scale=1, seed=0, year=YEAR, echo=None):
+    """Fill an initialized database with the spring term of ``year``.
+
+    ``scale`` multiplies the sizes of ``SCALE``; the same ``seed`` and
+    ``year`` always give the same data. Every fake user gets
+    ``ADMIN_PASSWORD``, hashed once. Returns the number of rows inserted per
+    table.
+    """
+    echo = echo or (lambda message: None)
+    rng.seed(seed)
+    fake.seed_instance(seed)
+
+    password_hash = hash_password(current_app.config['ADMIN_PASSWORD'])
+    remarks = [fake.text() for _ in range(200)]
+    grades = [str(year - i) for i in range(SCALE['grades'])]
+    term_start = datetime.date(year, 2, 20)
+
+    teacher_count = max(1, int(round(SCALE['teachers'] * scale)))
+    echo('Generating %d teachers...' % teacher_count)
+    teachers = fake_teacher(teacher_count, password_hash, remarks)
+
+    students = {}
+    for grade in grades:
+        count = max(2, int(round(SCALE['students'] * scale * rng.uniform(0.8, 1.2))))
+        echo('Generating %d students of %s...' % (count, grade))
+        students[grade] = fake_student(count, grade, password_hash, remarks)
+
+    course_count = max(1, int(round(SCALE['courses'] * scale)))
+    echo('Generating %d courses per grade...' % course_count)
+    courses = fake_course(grades, course_count, teachers, remarks, term_start)
+
+    echo('Generating reports...')
+    reports = fake_report(courses, students, remarks)
+
+    echo('Generating records of %d reports...' % len(reports))
+    records = fake_record(reports, courses, students, remarks)
+
+    db.session.commit()
+    return {
+        'teachers': len(teachers),
+        'students': sum(len(ids) for ids in students.values()),
+        'courses': len(courses),
+        'reports': len(reports),
+        'records': records,
+    }
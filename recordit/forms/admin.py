@@ -93,7 +93,7 @@ class RegisterBatchForm(FlaskForm):
         _l("Students or Teachers EXCEL file"),
         validators=[
             FileRequired(),
-            FileAllowed(['xls', 'xlsx'], _l("'xls' or 'xlsx' only!"))
+            FileAllowed(['xls', 'xlsx', 'csv'], _l("'xls', 'xlsx' or 'csv' only!"))
         ]
     )
 
@@ -193,7 +193,7 @@ class AddCourseAdministratorForm(FlaskForm):
         user = User.query.filter_by(number=field.data).first()
         if user is None:
             raise ValidationError(_l('The user is not existed.'))
-        elif user.role.name != 'Teacher':
+        elif not user.is_teacher:
             raise ValidationError(_l('The user is not Teacher.'))
 
     def validate_grade(self, field):
@@ -241,7 +241,7 @@ class AddReportForm(FlaskForm):
         user = User.query.filter_by(number=field.data).first()
         if user is None:
             raise ValidationError(_l('The speaker is not existed.'))
-        elif user.role.name != 'Student':
+        elif not user.is_student:
             raise ValidationError(_l('The speaker is not Student.'))
 
 
@@ -250,7 +250,7 @@ class AddReportBatchForm(FlaskForm):
         _l("Reports EXCEL file"),
         validators=[
             FileRequired(),
-            FileAllowed(['xls', 'xlsx'], _l("'xls' or 'xlsx' only!"))
+            FileAllowed(['xls', 'xlsx', 'csv'], _l("'xls', 'xlsx' or 'csv' only!"))
         ]
     )
 
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+
+import codecs
+import csv
+import re
+from os import path
+
+from flask_babel import _
+from sqlalchemy.exc import IntegrityError
+
+from recordit.extensions import db
+from recordit.models import Report, User, role_registry
+from recordit.passwords import hash_passwords
+
+USER_COLUMNS = ['number', 'name', 'role', 'remark', 'password']
+REPORT_COLUMNS = ['name', 'number', 'remark']
+
+NUMBER = re.compile(r'^[0-9]+$')
+
+# role -> (shortest, longest) number, as in the register forms
+NUMBER_LENGTH = {
+    'Student': (12, 12),
+    'Teacher': (4, 12),
+}
+
+
+class SpreadsheetError(ValueError):
+    """An upload that cannot be read as a spreadsheet of the expected columns."""
+
+
+def read_rows(file, columns):
+    """Open the uploaded ``file`` and check its header, then return its rows.
+
+    xlsx files are read in openpyxl's read-only mode and CSV files as text,
+    both straight from the upload stream, so nothing is written to
+    disk and rows are only parsed as they are consumed. The header is
+    checked for ``columns`` before any row is read; a malformed file or a
+    missing column raises ``SpreadsheetError`` right away. Rows come as
+    dicts keyed by the header and blank rows are skipped. Legacy xls files
+    are loaded whole with xlrd.
+    """
+    extension = path.splitext(file.filename)[-1].lower()
+    try:
+        if extension == '.csv':
+            lines = csv.reader(codecs.iterdecode(file.stream, csv_encoding(file.stream)))
+        elif extension == '.xls':
+            import xlrd
+
+            sheet = xlrd.open_workbook(file_contents=file.read()).sheet_by_index(0)
+            lines = (sheet.row_values(i) for i in range(sheet.nrows))
+        else:
+            from openpyxl import load_workbook
+
+            workbook = load_workbook(file.stream, read_only=True, data_only=True)
+            lines = workbook.worksheets[0].iter_rows(values_only=True)
+
+        header = [cell(value) for value in next(lines, [])]
+    except Exception:
+        raise SpreadsheetError(_('The file is not a valid spreadsheet.'))
+
+    missing = [column for column in columns if column not in header]
+    if missing:
+        raise SpreadsheetError(_('The file columns should contain %(columns)s.',
+                                 columns=', '.join("'%s'" % column for column in columns)))
+
+    def rows():
+        try:
+            for line in lines:
+                if any(cell(value) for value in line):
+                    yield dict(zip(header, line))
+        except Exception:
+            # a broken CSV line or encoding, or sheet XML cut off after the header
+            raise SpreadsheetError(_('The file is not a valid spreadsheet.'))
+
+    return rows()
+
+
+def csv_encoding(stream, sample_size=64 * 1024):
+    """The encoding of a CSV upload: UTF-8 when its start decodes as such,
+    otherwise GB18030, which is what Excel saves on zh-CN systems. The
+    stream is rewound."""
+    sample = stream.read(sample_size)
+    stream.seek(0)
+    try:
+        # incremental, so a character cut by the end of the sample is fine
+        codecs.getincrementaldecoder('utf-8-sig')().decode(sample)
+    except UnicodeDecodeError:
+        return 'gb18030'
+    return 'utf-8-sig'
+
+
+def cell(value):
+    """A spreadsheet cell as text: empty cells become '' and whole numbers
+    read as floats, like 201612345678.0, lose their decimal part."""
+    if value is None or value != value:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def validate_user(row):
+    """The reason ``row`` cannot be registered, or None."""
+    if row['role'] not in NUMBER_LENGTH:
+        return _("Role should be 'Student' or 'Teacher'.")
+
+    shortest, longest = NUMBER_LENGTH[row['role']]
+    if not NUMBER.match(row['number']):
+        return _('The username should only contain 0-9.')
+    if not shortest <= len(row['number']) <= longest:
+        return _('The username should have %(shortest)d to %(longest)d digits.',
+                 shortest=shortest, longest=longest)
+    if not 1 <= len(row['name']) <= 20:
+        return _('The name should have 1 to 20 characters.')
+    if not 8 <= len(row['password']) <= 128:
+        return _('The password should have 8 to 128 characters.')
+
+
+def import_users(rows, batch_size=1000):
+    """Register the users of spreadsheet ``rows`` in one transaction.
+
+    Numbers already taken are looked up in a single query and every row is
+    validated in memory before anything is written; the passwords of the
+    valid ones are hashed in parallel and they are inserted in batches of
+    ``batch_size``. Returns one result per row, in
+    order, with its ``status`` ('created' or 'failed') and a ``message``;
+    passwords are left out.
+    """
+    results = []
+    # the header is line 1 of the spreadsheet
+    for i, row in enumerate(rows, 2):
+        result = dict((column, cell(row.get(column))) for column in USER_COLUMNS)
+        result.update(row=i, status='failed', message=None)
+        results.append(result)
+
+    numbers = set(result['number'] for result in results if result['number'])
+    existing = set()
+    if numbers:
+        existing = set(number for number, in db.session.query(User.number).filter(
+            User.number.in_(numbers)))
+
+    seen = set()
+    valid = []
+    for result in results:
+        message = validate_user(result)
+        if message is None and result['number'] in existing:
+            message = _('%(number)s is already existed.', number=result['number'])
+        if message is None and result['number'] in seen:
+            message = _('%(number)s appears more than once.', number=result['number'])
+        seen.add(result['number'])
+
+        if message is not None:
+            result['message'] = message
+        else:
+            valid.append(result)
+
+    hashes = hash_passwords([result['password'] for result in valid])
+    rows = [{
+        'number': result['number'],
+        'name': result['name'],
+        'remark': result['remark'] or None,
+        'password_hash': password_hash,
+        'role_id': role_registry.id(result['role']),
+    } for result, password_hash in zip(valid, hashes)]
+
+    table = User.__table__
+    try:
+        for start in range(0, len(rows), batch_size):
+            db.session.execute(table.insert(), rows[start:start + batch_size])
+        db.session.commit()
+    except IntegrityError:
+        # a number was taken meanwhile, by another import or a register form
+        db.session.rollback()
+        for result in valid:
+            result['message'] = _('Nothing was registered, some numbers were taken meanwhile.')
+    else:
+        for result in valid:
+            result['status'] = 'created'
+
+    for result in results:
+        del result['password']
+    return results
+
+
+def import_reports(course, rows, batch_size=1000):
+    """Add the reports of spreadsheet ``rows`` to ``course`` in one transaction.
+
+    All speaker numbers are resolved with a single ``IN`` query and each
+    speaker's grade is checked against ``course.grade`` in memory; the valid
+    reports are then inserted in batches of ``batch_size``. Returns one
+    result per row, like ``import_users``, with the ``speaker`` name when
+    the number is known.
+    """
+    results = []
+    for i, row in enumerate(rows, 2):
+        result = dict((column, cell(row.get(column))) for column in REPORT_COLUMNS)
+        result.update(row=i, speaker=None, speaker_id=None, status='failed', message=None)
+        results.append(result)
+
+    numbers = set(result['number'] for result in results if result['number'])
+    speakers = {}
+    if numbers:
+        speakers = dict((user.number, user) for user in db.session.query(
+            User.id, User.number, User.name, User.role_id).filter(User.number.in_(numbers)))
+
+    student_id = role_registry.id('Student')
+    valid = []
+    for result in results:
+        speaker = speakers.get(result['number'])
+        if speaker is not None:
+            result['speaker'] = speaker.name
+
+        if not 1 <= len(result['name']) <= 30:
+            result['message'] = _('The report name should have 1 to 30 characters.')
+        elif speaker is None:
+            result['message'] = _('%(number)s is not existed.', number=result['number'])
+        elif speaker.role_id != student_id or speaker.number[:4] != course.grade:
+            result['message'] = _('The %(speaker)s is not belong to this course.',
+                                  speaker=speaker.number)
+        else:
+            result['speaker_id'] = speaker.id
+            valid.append(result)
+
+    rows = [{
+        'course_id': course.id,
+        'speaker_id': result['speaker_id'],
+        'name': result['name'],
+        'remark': result['remark'] or None,
+    } for result in valid]
+
+    table = Report.__table__
+    for start in range(0, len(rows), batch_size):
+        db.session.execute(table.insert(), rows[start:start + batch_size])
+    db.session.commit()
+
+    for result in valid:
+        result['status'] = 'created'
+    return results
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+import atexit
+import copy
+import hashlib
+import logging
+import os
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener, SMTPHandler
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+from flask import has_request_context, request
+
+
+class RequestFormatter(logging.Formatter):
+
+    def format(self, record):
+        record.url = getattr(record, 'url', '-')
+        record.remote_addr = getattr(record, 'remote_addr', '-')
+        return super(RequestFormatter, self).format(record)
+
+
+class BackgroundHandler(QueueHandler):
+    """Hand records to ``handlers`` running on a listener thread.
+
+    The request thread only captures the request details and the formatted
+    traceback and puts the record on a queue; file rotation and mail
+    delivery happen on the listener. The listener is started lazily in each
+    process, since uwsgi forks workers after the app is created.
+    """
+
+    def __init__(self, *handlers):
+        super(BackgroundHandler, self).__init__(Queue(-1))
+        self.handlers = handlers
+        self.listener = None
+        self.pid = None
+        self.lock = threading.Lock()
+        atexit.register(self.stop)
+
+    def start(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.listener = QueueListener(
+                    self.queue, *self.handlers, respect_handler_level=True)
+                self.listener.start()
+
+    def stop(self):
+        if self.listener is not None and self.pid == os.getpid():
+            self.listener.stop()
+            self.listener = None
+            self.pid = None
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        if has_request_context():
+            record.url = request.url
+            record.remote_addr = request.remote_addr
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def emit(self, record):
+        if self.pid != os.getpid():
+            self.start()
+        super(BackgroundHandler, self).emit(record)
+
+
+class ThrottledSMTPHandler(SMTPHandler):
+    """Mail each distinct error at most once per ``window`` seconds.
+
+    Errors are told apart by their traceback, or by their location and
+    message when there is none. Repeats inside the window are only
+    counted, and the count is reported with the next mail for that error.
+    No more than ``limit`` mails in total go out per window. An error is
+    forgotten once its window has passed, or one window later when it still
+    has repeats to report, so the handler does not grow with every error
+    ever seen.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.window = kwargs.pop('window', 600)
+        self.limit = kwargs.pop('limit', 10)
+        super(ThrottledSMTPHandler, self).__init__(*args, **kwargs)
+        self.seen = {}
+        self.sent = []
+
+    def key(self, record):
+        text = record.exc_text or '%s:%s:%s' % (
+            record.pathname, record.lineno, record.msg)
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def emit(self, record):
+        now = time.time()
+        key = self.key(record)
+        first, repeated = self.seen.get(key, (None, 0))
+
+        self.seen = dict(
+            (seen, (since, count)) for seen, (since, count) in self.seen.items()
+            if now - since < self.window * (2 if count else 1))
+        self.sent = [sent for sent in self.sent if now - sent < self.window]
+        if (first is not None and now - first < self.window) or len(self.sent) >= self.limit:
+            self.seen[key] = (first if first is not None else now, repeated + 1)
+            return
+
+        if repeated:
+            record = copy.copy(record)
+            record.msg = '%s\n(repeated %d more times in the last %d seconds)' % (
+                record.msg, repeated, int(now - first))
+        self.seen[key] = (now, 0)
+        self.sent.append(now)
+        super(ThrottledSMTPHandler, self).emit(record)
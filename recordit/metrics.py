@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+
+import atexit
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from os import path
+
+from flask import current_app, g, request
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+HELP = {
+    'recordit_request_duration_seconds': 'Request latency by endpoint.',
+    'recordit_db_duration_seconds': 'Database time per sampled request by endpoint.',
+    'recordit_db_statements': 'SQL statements per sampled request by endpoint.',
+    'recordit_response_size_bytes': 'Response body size by endpoint.',
+    'recordit_requests_total': 'Finished requests by endpoint and status.',
+    'recordit_export_cache_total': 'Export archive cache lookups by result.',
+    'recordit_export_duration_seconds': 'Time to build an export archive by kind.',
+    'recordit_import_duration_seconds': 'Time to import an uploaded spreadsheet by kind.',
+    'recordit_import_rows': 'Rows per imported spreadsheet by kind.',
+}
+
+
+class Metrics(object):
+    """Counters and histograms shared by every uwsgi worker.
+
+    Each process keeps its own figures in memory and every
+    ``METRICS_FLUSH_INTERVAL`` seconds writes them to ``METRICS_PATH`` as
+    ``metrics-<pid>.json``, and once more at exit. ``render`` adds up the
+    files of all workers, so the figures cover the whole server. The files
+    of workers that have exited are folded into ``metrics-retired.json``,
+    so their counters are kept without piling up files, and a new worker
+    that gets the pid of a dead one never overwrites them; totals never go
+    backwards.
+    """
+
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.flushed = 0
+        self.owner = None
+        self.app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_PATH', None)
+        app.config.setdefault('METRICS_FLUSH_INTERVAL', 5)
+
+        self.app = app
+        app.extensions['metrics'] = self
+        atexit.register(self.flush)
+        app.before_request(self.before_request)
+        # registered after sqlstats, so this runs before it drops g.sql_stats
+        app.after_request(self.after_request)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {
+                    'buckets': list(buckets), 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+            index = bisect_left(histogram['buckets'], value)
+            if index < len(histogram['counts']):
+                histogram['counts'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def before_request(self):
+        g.request_start = time.time()
+
+    def after_request(self, response):
+        start = g.pop('request_start', None)
+        if start is None:
+            return response
+
+        endpoint = request.endpoint or 'unknown'
+        labels = {'blueprint': request.blueprint or '', 'endpoint': endpoint}
+        self.observe('recordit_request_duration_seconds', time.time() - start, **labels)
+        self.inc('recordit_requests_total', status=str(response.status_code), **labels)
+
+        if response.content_length is not None:
+            self.observe('recordit_response_size_bytes', response.content_length,
+                         buckets=(1e3, 1e4, 1e5, 1e6, 1e7, 1e8), **labels)
+
+        stats = g.get('sql_stats')
+        if stats is not None:
+            self.observe('recordit_db_duration_seconds', stats['time'], **labels)
+            self.observe('recordit_db_statements', stats['count'],
+                         buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500), **labels)
+
+        if time.time() - self.flushed >= current_app.config['METRICS_FLUSH_INTERVAL']:
+            self.flush()
+        return response
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': [[name, dict(labels), value]
+                             for (name, labels), value in self.counters.items()],
+                'histograms': [[name, dict(labels), dict(histogram, counts=list(histogram['counts']))]
+                               for (name, labels), histogram in self.histograms.items()],
+            }
+
+    def flush(self):
+        metrics_path = self.app.config['METRICS_PATH']
+        self.flushed = time.time()
+        if not metrics_path:
+            return
+
+        if not path.isdir(metrics_path):
+            os.makedirs(metrics_path, exist_ok=True)
+        if self.owner != os.getpid():
+            # a file under our pid was left by a dead worker that had it before
+            self.retire(metrics_path, [os.getpid()])
+            self.owner = os.getpid()
+
+        file = path.join(metrics_path, 'metrics-%d.json' % os.getpid())
+        temp = file + '.part'
+        with open(temp, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(temp, file)
+
+    def retire(self, metrics_path, pids):
+        """Fold the files of ``pids`` into ``metrics-retired.json``."""
+        with locked(metrics_path, exclusive=True):
+            snapshots = []
+            files = []
+            for pid in pids:
+                file = path.join(metrics_path, 'metrics-%d.json' % pid)
+                snapshot = read_snapshot(file)
+                if snapshot is not None:
+                    snapshots.append(snapshot)
+                    files.append(file)
+            if not snapshots:
+                return
+
+            retired = path.join(metrics_path, 'metrics-retired.json')
+            previous = read_snapshot(retired)
+            if previous is not None:
+                snapshots.append(previous)
+            temp = retired + '.part'
+            with open(temp, 'w') as f:
+                json.dump(as_snapshot(*merge(snapshots)), f)
+            os.replace(temp, retired)
+            for file in files:
+                os.remove(file)
+
+    def collect(self):
+        """Figures of every worker that has flushed, this one up to date."""
+        self.flush()
+        metrics_path = self.app.config['METRICS_PATH']
+        if not (metrics_path and path.isdir(metrics_path)):
+            return merge([self.snapshot()])
+
+        dead = [pid for pid in worker_pids(metrics_path) if not alive(pid)]
+        if dead:
+            self.retire(metrics_path, dead)
+
+        # under the lock, so a file is never seen both retired and not
+        snapshots = []
+        with locked(metrics_path, exclusive=False):
+            for name in os.listdir(metrics_path):
+                if name.startswith('metrics-') and name.endswith('.json'):
+                    snapshot = read_snapshot(path.join(metrics_path, name))
+                    if snapshot is not None:
+                        snapshots.append(snapshot)
+        return merge(snapshots)
+
+    def render(self):
+        """All figures in the Prometheus text exposition format."""
+        counters, histograms = self.collect()
+        lines = []
+
+        for name in sorted(set(key[0] for key in counters)):
+            lines.append('# HELP %s %s' % (name, HELP.get(name, name)))
+            lines.append('# TYPE %s counter' % name)
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append('%s%s %s' % (name, format_labels(labels), value))
+
+        for name in sorted(set(key[0] for key in histograms)):
+            lines.append('# HELP %s %s' % (name, HELP.get(name, name)))
+            lines.append('# TYPE %s histogram' % name)
+            for (metric, labels), histogram in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(histogram['buckets'], histogram['counts']):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (
+                        name, format_labels(labels + (('le', repr(float(bound))),)), cumulative))
+                lines.append('%s_bucket%s %d' % (
+                    name, format_labels(labels + (('le', '+Inf'),)), histogram['count']))
+                lines.append('%s_sum%s %s' % (name, format_labels(labels), histogram['sum']))
+                lines.append('%s_count%s %d' % (name, format_labels(labels), histogram['count']))
+
+        return '\n'.join(lines) + '\n'
+
+
+@contextmanager
+def locked(metrics_path, exclusive):
+    """Hold the lock of the metric files, shared by every worker."""
+    import fcntl
+
+    with open(path.join(metrics_path, '.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def read_snapshot(file):
+    try:
+        with open(file) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def worker_pids(metrics_path):
+    pids = []
+    for name in os.listdir(metrics_path):
+        pid = name[len('metrics-'):-len('.json')]
+        if name.startswith('metrics-') and name.endswith('.json') and pid.isdigit():
+            pids.append(int(pid))
+    return pids
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def merge(snapshots):
+    """Add ``snapshots`` up into ``(counters, histograms)``."""
+    counters = {}
+    histograms = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(sorted(labels.items())))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, histogram in snapshot['histograms']:
+            key = (name, tuple(sorted(labels.items())))
+            total = histograms.get(key)
+            if total is None:
+                histograms[key] = dict(histogram, counts=list(histogram['counts']))
+            else:
+                total['counts'] = [a + b for a, b in zip(total['counts'], histogram['counts'])]
+                total['sum'] += histogram['sum']
+                total['count'] += histogram['count']
+    return counters, histograms
+
+
+def as_snapshot(counters, histograms):
+    return {
+        'counters': [[name, dict(labels), value] for (name, labels), value in counters.items()],
+        'histograms': [[name, dict(labels), histogram]
+                       for (name, labels), histogram in histograms.items()],
+    }
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels)
+
+
+metrics = Metrics()
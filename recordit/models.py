@@ -4,9 +4,26 @@ import datetime
 
 from flask import current_app
 from flask_login import UserMixin
-from werkzeug.security import check_password_hash, generate_password_hash
+from sqlalchemy import and_, case, func, orm, select
+from werkzeug.security import check_password_hash
 
 from recordit.extensions import db
+from recordit.passwords import hash_password, needs_rehash
+
+
+def eager(*attrs):
+    """Build an eager loader option along the relationship path ``attrs``.
+
+    The strategy ('joined' or 'selectin') comes from the
+    ``EAGER_LOADING_STRATEGY`` config, so listing pages load the rows they
+    render in a constant number of statements.
+    """
+    loader = current_app.config['EAGER_LOADING_STRATEGY'] + 'load'
+    option = getattr(orm, loader)(attrs[0])
+    for attr in attrs[1:]:
+        option = getattr(option, loader)(attr)
+    return option
+
 
 # relationship table
 roles_permissions = db.Table(
@@ -30,14 +47,16 @@ class Role(db.Model):
     permissions = db.relationship(
         'Permission', secondary=roles_permissions, back_populates='roles')
 
+    roles_permissions_map = {
+        'Student': ['RECORD'],
+        'Teacher': ['RECORD', 'MODERATOR_COURSE', 'MODERATOR_REPORT', 'MODERATOR_RECORD_TABLE'],
+        'Administrator': ['RECORD', 'MODERATOR_COURSE', 'MODERATOR_REPORT', 'MODERATOR_RECORD_TABLE',
+                          'MODERATOR_LOG', 'ADMINISTER']
+    }
+
     @staticmethod
     def init_role():
-        roles_permissions_map = {
-            'Student': ['RECORD'],
-            'Teacher': ['RECORD', 'MODERATOR_COURSE', 'MODERATOR_REPORT', 'MODERATOR_RECORD_TABLE'],
-            'Administrator': ['RECORD', 'MODERATOR_COURSE', 'MODERATOR_REPORT', 'MODERATOR_RECORD_TABLE',
-                              'MODERATOR_LOG', 'ADMINISTER']
-        }
+        roles_permissions_map = Role.roles_permissions_map
 
         for role_name in roles_permissions_map:
             role = Role.query.filter_by(name=role_name).first()
@@ -55,6 +74,61 @@ class Role(db.Model):
                 role.permissions.append(permission)
 
         db.session.commit()
+        role_registry.invalidate()
+
+
+class RoleRegistry(object):
+    """In-process map of role names to ids and permissions to bits.
+
+    Permission bits and role masks come from ``Role.roles_permissions_map``;
+    only the role ids are read from the database, once per process and again
+    after the roles change. ``User.can`` and ``User.whoami`` are then plain
+    integer checks.
+    """
+
+    def __init__(self):
+        self.bits = {}
+        self.masks = {}
+        for role_name, permission_names in Role.roles_permissions_map.items():
+            mask = 0
+            for permission_name in permission_names:
+                if permission_name not in self.bits:
+                    self.bits[permission_name] = 1 << len(self.bits)
+                mask |= self.bits[permission_name]
+            self.masks[role_name] = mask
+        self._ids = None
+
+    def invalidate(self):
+        self._ids = None
+
+    @property
+    def ids(self):
+        ids = self._ids
+        if ids is None:
+            ids = self._ids = dict(db.session.query(Role.name, Role.id).all())
+        return ids
+
+    def id(self, role_name):
+        return self.ids.get(role_name)
+
+    def name(self, role_id):
+        for role_name, id_ in self.ids.items():
+            if id_ == role_id:
+                return role_name
+
+    def can(self, role_id, permission_name):
+        bit = self.bits.get(permission_name, 0)
+        return bool(bit and self.masks.get(self.name(role_id), 0) & bit)
+
+
+role_registry = RoleRegistry()
+
+
+@db.event.listens_for(Role, 'after_insert')
+@db.event.listens_for(Role, 'after_update')
+@db.event.listens_for(Role, 'after_delete')
+def invalidate_role_registry(mapper, connection, target):
+    role_registry.invalidate()
 
 
 class User(db.Model, UserMixin):
@@ -69,44 +143,60 @@ class User(db.Model, UserMixin):
     role_id = db.Column(db.Integer, db.ForeignKey('role.id'))
     role = db.relationship('Role', back_populates='users')
 
-    courses = db.relationship('Course', cascade='all, delete-orphan')
+    courses = db.relationship(
+        'Course', back_populates='teacher', cascade='all, delete-orphan')
 
     def __init__(self, **kwargs):
         super(User, self).__init__(**kwargs)
         self.init_role()
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
 
     def validate_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        if not check_password_hash(self.password_hash, password):
+            return False
+
+        if needs_rehash(self.password_hash):
+            # saved on a connection of its own, so whatever else is pending in
+            # the session is left for the view to commit or discard
+            password_hash = hash_password(password)
+            table = User.__table__
+            with db.engine.begin() as connection:
+                connection.execute(table.update().where(
+                    table.c.id == self.id).values(password_hash=password_hash))
+            orm.attributes.set_committed_value(self, 'password_hash', password_hash)
+        return True
 
     def init_role(self):
-        if self.role is None:
+        if self.role_id is None and self.role is None:
             if self.number == current_app.config['ADMIN_NUMBER']:
-                self.role = Role.query.filter_by(name='Administrator').first()
+                self.set_role('Administrator')
             else:
-                self.role = Role.query.filter_by(name='Student').first()
-            db.session.commit()
+                self.set_role('Student')
 
     def set_role(self, role):
-        self.role = Role.query.filter_by(name=role).first()
+        self.role_id = role_registry.id(role)
 
     @property
     def username(self):
         return self.number
 
+    @property
+    def role_name(self):
+        return role_registry.name(self.role_id)
+
     @property
     def is_admin(self):
-        return self.role.name == 'Administrator'
+        return self.whoami('Administrator')
 
     @property
     def is_teacher(self):
-        return self.role.name == 'Teacher'
+        return self.whoami('Teacher')
 
     @property
     def is_student(self):
-        return self.role.name == 'Student'
+        return self.whoami('Student')
 
     @property
     def grade(self):
@@ -115,17 +205,15 @@ class User(db.Model, UserMixin):
 
     @classmethod
     def all_grade(self):
-        role = Role.query.filter_by(name='Student').first()
-        studetns = User.query.filter_by(role_id=role.id).all()
-        studetn_grades = [user.grade for user in studetns]
-        return set(studetn_grades)
+        grades = db.session.query(func.substr(User.number, 1, 4)).filter(
+            User.role_id == role_registry.id('Student')).distinct()
+        return set(grade for grade, in grades)
 
     def can(self, permission_name):
-        permission = Permission.query.filter_by(name=permission_name).first()
-        return permission is not None and self.role is not None and permission in self.role.permissions
+        return self.role_id is not None and role_registry.can(self.role_id, permission_name)
 
     def whoami(self, role):
-        return self.role.name == role
+        return self.role_id is not None and self.role_id == role_registry.id(role)
 
 
 class Course(db.Model):
@@ -138,7 +226,9 @@ class Course(db.Model):
     date = db.Column(db.Date, index=True, default=datetime.date.today)
     remark = db.Column(db.Text)
 
-    reports = db.relationship('Report', cascade='all, delete-orphan')
+    teacher = db.relationship('User', back_populates='courses')
+    reports = db.relationship(
+        'Report', back_populates='course', cascade='all, delete-orphan')
 
     @property
     def is_active(self):
@@ -146,11 +236,11 @@ class Course(db.Model):
 
     @property
     def teacher_name(self):
-        return User.query.get(self.teacher_id).name
+        return self.teacher.name
 
     @property
     def teacher_number(self):
-        return User.query.get(self.teacher_id).number
+        return self.teacher.number
 
 
 class Report(db.Model):
@@ -160,47 +250,166 @@ class Report(db.Model):
     name = db.Column(db.String(30), nullable=False)
     score = db.Column(db.Float)
 
+    # running aggregate of the report's record tables, see ``update_score``
+    score_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    score_sum = db.Column(db.Float, nullable=False, default=0, server_default='0')
+    score_squares = db.Column(db.Float, nullable=False, default=0, server_default='0')
+    score_min = db.Column(db.Float)
+    score_max = db.Column(db.Float)
+    teacher_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    teacher_sum = db.Column(db.Float, nullable=False, default=0, server_default='0')
+    student_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    student_sum = db.Column(db.Float, nullable=False, default=0, server_default='0')
+    # bumped whenever the exported content of the report changes, see
+    # ``recordit.exports.record_version``
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
     active = db.Column(db.Boolean, default=True)
     date = db.Column(db.Date, index=True, default=datetime.date.today)
     remark = db.Column(db.Text)
 
-    recordtables = db.relationship('RecordTable', cascade='all, delete-orphan')
+    course = db.relationship('Course', back_populates='reports')
+    speaker = db.relationship('User')
+    recordtables = db.relationship(
+        'RecordTable', back_populates='report', cascade='all, delete-orphan')
 
     @property
     def grade(self):
-        return Course.query.get(self.course_id).grade
+        return self.course.grade
 
     @property
     def course_name(self):
-        return Course.query.get(self.course_id).name
+        return self.course.name
 
     @property
     def is_active(self):
-        return Course.query.get(self.course_id).is_active and self.active
+        return self.course.is_active and self.active
 
     @property
     def speaker_name(self):
-        return User.query.get(self.speaker_id).name
+        return self.speaker.name
 
     @property
     def speaker_number(self):
-        return User.query.get(self.speaker_id).number
+        return self.speaker.number
 
     @property
     def teacher_name(self):
-        return Course.query.get(self.course_id).teacher_name
+        return self.course.teacher_name
 
     @property
     def teacher_number(self):
-        return Course.query.get(self.course_id).teacher_number
+        return self.course.teacher_number
 
     @property
     def teacher_id(self):
-        return Course.query.get(self.course_id).teacher_id
+        return self.course.teacher_id
 
     def search_recordtabel(self, user_id):
         return RecordTable.query.filter(RecordTable.report_id == self.id, RecordTable.user_id == user_id).first()
 
+    @property
+    def score_variance(self):
+        if self.score_count:
+            mean = self.score_sum / self.score_count
+            return max(self.score_squares / self.score_count - mean ** 2, 0.0)
+
+    @property
+    def teacher_score(self):
+        if self.teacher_count:
+            return self.teacher_sum / self.teacher_count
+
+    @property
+    def student_score(self):
+        if self.student_count:
+            return self.student_sum / self.student_count
+
+    @staticmethod
+    def update_score(report_id, old=None, new=None, by_student=True):
+        """Fold one reviewer's score change into the report aggregate.
+
+        ``old`` is None for a new record table and ``new`` is None for a
+        deleted one. The change is applied as a single UPDATE in the current
+        transaction, so concurrent reviews never overwrite each other.
+        """
+        table = Report.__table__
+        count = (new is not None) - (old is not None)
+        total = (new or 0) - (old or 0)
+        group = 'student' if by_student else 'teacher'
+
+        values = {
+            'score_count': table.c.score_count + count,
+            'score_sum': table.c.score_sum + total,
+            'score_squares': table.c.score_squares + (new or 0) ** 2 - (old or 0) ** 2,
+            group + '_count': table.c[group + '_count'] + count,
+            group + '_sum': table.c[group + '_sum'] + total,
+            # the remark or attachment may have changed with the score
+            'version': table.c.version + 1,
+        }
+
+        if old is None:
+            values['score_min'] = case(
+                [(and_(table.c.score_min.isnot(None), table.c.score_min < new), table.c.score_min)],
+                else_=new)
+            values['score_max'] = case(
+                [(and_(table.c.score_max.isnot(None), table.c.score_max > new), table.c.score_max)],
+                else_=new)
+        else:
+            # the removed score may have been an extreme, take them from the rows
+            records = RecordTable.__table__
+            values['score_min'] = select([func.min(records.c.score)]).where(
+                records.c.report_id == report_id).as_scalar()
+            values['score_max'] = select([func.max(records.c.score)]).where(
+                records.c.report_id == report_id).as_scalar()
+
+        db.session.flush()
+        db.session.execute(
+            table.update().where(table.c.id == report_id).values(**values))
+        db.session.execute(
+            table.update().where(table.c.id == report_id).values(
+                score=case([(table.c.score_count > 0, table.c.score_sum / table.c.score_count)])))
+
+    @staticmethod
+    def touch_user(user_id):
+        """Bump the version of every report whose export shows ``user_id``,
+        as speaker, teacher or reviewer, after their name or number changed."""
+        table = Report.__table__
+        records = RecordTable.__table__
+        courses = Course.__table__
+        db.session.execute(table.update().where(
+            (table.c.speaker_id == user_id)
+            | table.c.course_id.in_(select([courses.c.id]).where(courses.c.teacher_id == user_id))
+            | table.c.id.in_(select([records.c.report_id]).where(records.c.user_id == user_id))
+        ).values(version=table.c.version + 1))
+
+    @staticmethod
+    def refresh_score(report_id=None):
+        """Rebuild the aggregates from the record tables, e.g. after an upgrade."""
+        query = Report.query
+        if report_id is not None:
+            query = query.filter_by(id=report_id)
+
+        for report in query.all():
+            rows = db.session.query(RecordTable.score, Role.name).join(
+                User, RecordTable.user_id == User.id).join(Role).filter(
+                RecordTable.report_id == report.id).all()
+            scores = [score for score, _ in rows]
+            students = [score for score, role in rows if role == 'Student']
+            teachers = [score for score, role in rows if role != 'Student']
+
+            report.score_count = len(scores)
+            report.score_sum = sum(scores)
+            report.score_squares = sum(score ** 2 for score in scores)
+            report.score_min = min(scores) if scores else None
+            report.score_max = max(scores) if scores else None
+            report.student_count = len(students)
+            report.student_sum = sum(students)
+            report.teacher_count = len(teachers)
+            report.teacher_sum = sum(teachers)
+            report.score = report.score_sum / len(scores) if scores else None
+
+        db.session.commit()
+
 
 class RecordTable(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -212,29 +421,32 @@ class RecordTable(db.Model):
     time = db.Column(db.DateTime, index=True, default=datetime.datetime.utcnow)
     remark = db.Column(db.Text)
 
+    report = db.relationship('Report', back_populates='recordtables')
+    reviewer = db.relationship('User')
+
     @property
     def course_id(self):
-        return Report.query.get(self.report_id).course_id
+        return self.report.course_id
 
     @property
     def is_active(self):
-        return Report.query.get(self.report_id).is_active
+        return self.report.is_active
 
     @property
     def report_name(self):
-        return Report.query.get(self.report_id).name
+        return self.report.name
 
     @property
     def reviewer_name(self):
-        return User.query.get(self.user_id).name
+        return self.reviewer.name
 
     @property
     def reviewer_number(self):
-        return User.query.get(self.user_id).number
+        return self.reviewer.number
 
     @property
     def teacher_id(self):
-        return Report.query.get(self.report_id).teacher_id
+        return self.report.teacher_id
 
 
 class Log(db.Model):
@@ -243,4 +455,7 @@ class Log(db.Model):
 
     ip = db.Column(db.String(128))
     time = db.Column(db.DateTime, index=True, default=datetime.datetime.utcnow)
+    # see recordit.audit.Event, ``content`` is only set on rows older than events
+    event = db.Column(db.SmallInteger, index=True)
+    params = db.Column(db.Text)
     content = db.Column(db.String(50))
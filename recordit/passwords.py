@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from flask import current_app
+from werkzeug.security import generate_password_hash
+
+
+def settings():
+    """The configured ``(method, salt_length)`` of new password hashes."""
+    return (current_app.config['PASSWORD_HASH_METHOD'],
+            current_app.config['PASSWORD_SALT_LENGTH'])
+
+
+def generate(args):
+    # module level, so the process pool can pickle it
+    password, method, salt_length = args
+    return generate_password_hash(password, method=method, salt_length=salt_length)
+
+
+# (pid, executor) of the pool of this worker process
+_pool = (None, None)
+_pool_lock = threading.Lock()
+
+
+def python_executable():
+    """The Python interpreter to spawn, or None when it cannot be found.
+
+    Under uwsgi ``sys.executable`` is the uwsgi binary, so the interpreter
+    of the running environment is looked up next to its libraries instead.
+    """
+    if 'python' in os.path.basename(sys.executable or ''):
+        return sys.executable
+    for name in ('python%d.%d' % sys.version_info[:2], 'python3', 'python'):
+        executable = os.path.join(sys.exec_prefix, 'bin', name)
+        if os.access(executable, os.X_OK):
+            return executable
+    return None
+
+
+def pool(workers):
+    """The process pool of this worker process, started on first use, or
+    None when no interpreter can be spawned.
+
+    uwsgi workers run the scheduler, audit and logging threads, and forking
+    a process with threads may copy a lock held by one of them. The pool
+    therefore spawns fresh interpreters instead of forking, and does so
+    only once per worker process rather than for every batch.
+    """
+    global _pool
+    with _pool_lock:
+        pid, executor = _pool
+        if pid != os.getpid() or executor is None:
+            executable = python_executable()
+            if executable is None:
+                return None
+            context = multiprocessing.get_context('spawn')
+            context.set_executable(executable)
+            executor = ProcessPoolExecutor(workers, mp_context=context)
+            _pool = os.getpid(), executor
+        return executor
+
+
+def drop_pool():
+    global _pool
+    with _pool_lock:
+        _pool = (None, None)
+
+
+def hash_password(password):
+    method, salt_length = settings()
+    return generate((password, method, salt_length))
+
+
+def hash_passwords(passwords):
+    """Hash ``passwords`` on a pool of ``PASSWORD_HASH_WORKERS`` processes.
+
+    Hashing is deliberately slow, so a batch scales with the cores instead
+    of taking one request thread. Each uwsgi worker keeps its own pool, so
+    the setting is per worker process. Small batches, any batch when only
+    one worker is configured, and batches the pool cannot take because it
+    could not start or broke, are hashed in this process. Returns the
+    hashes in the order of ``passwords``.
+    """
+    method, salt_length = settings()
+    args = [(password, method, salt_length) for password in passwords]
+    workers = current_app.config['PASSWORD_HASH_WORKERS']
+
+    if workers <= 1 or len(args) < 2 * workers:
+        return [generate(arg) for arg in args]
+
+    executor = pool(workers)
+    if executor is not None:
+        try:
+            return list(executor.map(
+                generate, args, chunksize=max(1, len(args) // (workers * 4))))
+        except (BrokenProcessPool, OSError):
+            current_app.logger.exception('The password hash pool broke, hashing in process.')
+            drop_pool()
+    return [generate(arg) for arg in args]
+
+
+def needs_rehash(password_hash):
+    """Whether ``password_hash`` was made with another method or salt length
+    than the configured ones.
+
+    A configured method without a cost, like ``pbkdf2:sha256``, accepts any
+    cost, since werkzeug fills in its own default.
+    """
+    method, salt_length = settings()
+    try:
+        stored, salt, _ = password_hash.split('$', 2)
+    except (AttributeError, ValueError):
+        return True
+
+    if len(salt) != salt_length:
+        return True
+    if method.count(':') < stored.count(':'):
+        return stored.rsplit(':', 1)[0] != method
+    return stored != method
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import re
+import time
+import tracemalloc
+from os import path
+from uuid import uuid4
+
+from flask import current_app, g, has_request_context, request
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from recordit.sqlstats import shape
+
+PROFILE_ID = re.compile(r'^\d{8}-\d{6}-[0-9a-f]{8}$')
+
+
+class Profiler(object):
+    """Profile single requests on demand.
+
+    A request carrying the ``PROFILER_HEADER`` header or the
+    ``PROFILER_ARG`` query argument, sent by a user who can ``ADMINISTER``,
+    runs under ``cProfile`` with ``tracemalloc`` tracing. Its profile and a
+    summary with the peak memory and every SQL statement are written to
+    ``PROFILER_PATH``, of which the newest ``PROFILER_MAX_FILES`` are kept.
+    Every other request goes through untouched.
+
+    ``tracemalloc`` is process wide, so the peak includes whatever other
+    threads of the worker allocate meanwhile.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PROFILER_PATH', None)
+        app.config.setdefault('PROFILER_HEADER', 'X-Profile')
+        app.config.setdefault('PROFILER_ARG', '_profile')
+        app.config.setdefault('PROFILER_MAX_FILES', 50)
+
+        app.extensions['profiler'] = self
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.teardown_request(self.teardown_request)
+
+        if not event.contains(Engine, 'before_cursor_execute', before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+
+    def requested(self):
+        config = current_app.config
+        if not config['PROFILER_PATH']:
+            return False
+        if not (request.headers.get(config['PROFILER_HEADER'])
+                or request.args.get(config['PROFILER_ARG'])):
+            return False
+        return current_user.can('ADMINISTER')
+
+    def before_request(self):
+        if not self.requested():
+            return
+
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        elif hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+
+        g.profile = {
+            'profile': cProfile.Profile(),
+            'queries': [],
+            'tracing': tracing,
+            'start': time.time(),
+        }
+        g.profile['profile'].enable()
+
+    def after_request(self, response):
+        profile = self.stop()
+        if profile is None:
+            return response
+
+        profile_id = self.save(profile, response)
+        response.headers['X-Profile-Id'] = profile_id
+        return response
+
+    def teardown_request(self, exc):
+        # the request failed before after_request could stop the profiler
+        self.stop()
+
+    def stop(self):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return None
+
+        profile['profile'].disable()
+        profile['duration'] = time.time() - profile['start']
+        profile['peak_memory'] = tracemalloc.get_traced_memory()[1]
+        if not profile['tracing']:
+            tracemalloc.stop()
+        return profile
+
+    def save(self, profile, response):
+        profile_path = current_app.config['PROFILER_PATH']
+        if not path.isdir(profile_path):
+            os.makedirs(profile_path)
+
+        profile_id = '%s-%s' % (time.strftime('%Y%m%d-%H%M%S'), uuid4().hex[:8])
+        profile['profile'].dump_stats(profile_file(profile_id, 'prof'))
+
+        buffer = io.StringIO()
+        stats = pstats.Stats(profile['profile'], stream=buffer)
+        stats.sort_stats('cumulative').print_stats(30)
+
+        summary = {
+            'id': profile_id,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(profile['start'])),
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'user': current_user.number,
+            'duration': round(profile['duration'], 4),
+            'peak_memory': profile['peak_memory'],
+            'sql_count': len(profile['queries']),
+            'sql_time': round(sum(query['duration'] for query in profile['queries']), 4),
+            'queries': profile['queries'],
+            'stats': buffer.getvalue(),
+        }
+        with open(profile_file(profile_id, 'json'), 'w') as f:
+            json.dump(summary, f, default=str)
+
+        self.prune()
+        return profile_id
+
+    def prune(self):
+        profile_path = current_app.config['PROFILER_PATH']
+        ids = sorted(name[:-len('.json')] for name in os.listdir(profile_path)
+                     if name.endswith('.json'))
+        for profile_id in ids[:-current_app.config['PROFILER_MAX_FILES']]:
+            for kind in ('json', 'prof'):
+                if path.exists(profile_file(profile_id, kind)):
+                    os.remove(profile_file(profile_id, kind))
+
+    def profiles(self):
+        """Summaries of the stored profiles, newest first, without their traces."""
+        profile_path = current_app.config['PROFILER_PATH']
+        if not profile_path or not path.isdir(profile_path):
+            return []
+
+        profiles = []
+        for name in sorted(os.listdir(profile_path), reverse=True):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(path.join(profile_path, name)) as f:
+                    summary = json.load(f)
+            except (IOError, ValueError):
+                continue
+            summary.pop('queries', None)
+            summary.pop('stats', None)
+            profiles.append(summary)
+        return profiles
+
+
+def profile_file(profile_id, kind):
+    """Path of the ``prof`` or ``json`` file of ``profile_id``, or None when
+    the id is malformed."""
+    if not PROFILE_ID.match(profile_id):
+        return None
+    return path.join(current_app.config['PROFILER_PATH'], '%s.%s' % (profile_id, kind))
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'profile' in g:
+        conn.info.setdefault('profile_start', []).append(time.time())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if not (has_request_context() and 'profile' in g and conn.info.get('profile_start')):
+        return
+
+    g.profile['queries'].append({
+        'statement': statement,
+        'parameters': shape(parameters[0] if executemany and parameters else parameters),
+        'executemany': len(parameters) if executemany else None,
+        'duration': round(time.time() - conn.info['profile_start'].pop(), 6),
+    })
+
+
+profiler = Profiler()
@@ -29,11 +29,15 @@ class BaseConfig(object):
     MAIL_PASSWORD = os.getenv('SENDGRID_API_KEY')
     MAIL_USE_SSL = True
     MAIL_DEFAULT_SENDER = MAIL_USERNAME
+    # one mail per distinct error per window, at most ERROR_MAIL_LIMIT per window
+    ERROR_MAIL_WINDOW = 10 * 60
+    ERROR_MAIL_LIMIT = 10
 
     DEBUG_TB_INTERCEPT_REDIRECTS = False
 
     SQLALCHEMY_TRACK_MODIFICATIONS = False
-    SQLALCHEMY_RECORD_QUERIES = True
+    # 'joined' or 'selectin', used by listing pages to load related rows
+    EAGER_LOADING_STRATEGY = os.getenv('EAGER_LOADING_STRATEGY', 'joined')
 
     LOCALES = ['zh_Hans_CN', 'en_US']
     BABEL_DEFAULT_LOCALE = LOCALES[0]
@@ -56,10 +60,47 @@ class BaseConfig(object):
     RECORD_TABLE_UPPER_LIMIT = 100
 
     FILE_CACHE_PATH = os.path.join(basedir, 'cache')
+    EXPORT_CACHE_PATH = os.path.join(FILE_CACHE_PATH, 'exports')
+    EXPORT_CACHE_MAX_SIZE = 512 * 1024 * 1024
+    EXPORT_CACHE_MAX_AGE = 3 * 24 * 60 * 60
+    EXPORT_JOB_TIMEOUT = 30 * 60
+    EXPORT_WORKERS = int(os.getenv('EXPORT_WORKERS', 2))
     SYSTEM_LOG_PATH = os.path.join(basedir, 'logs/recordit.log')
 
+    AUDIT_BUFFERED = True
+    AUDIT_FLUSH_INTERVAL = float(os.getenv('AUDIT_FLUSH_INTERVAL', 2))
+    AUDIT_FLUSH_SIZE = int(os.getenv('AUDIT_FLUSH_SIZE', 200))
+
+    LOG_RETENTION_DAYS = int(os.getenv('LOG_RETENTION_DAYS', 90))
+    LOG_ARCHIVE_PATH = os.path.join(basedir, 'logs/archive')
+
+    SQL_STATS_SAMPLE_RATE = float(os.getenv('SQL_STATS_SAMPLE_RATE', 1))
+    SQL_SLOW_QUERY_THRESHOLD = float(os.getenv('SQL_SLOW_QUERY_THRESHOLD', 0.2))
+    SQL_SLOW_QUERY_EXPLAIN = False
+    SQL_SLOW_QUERY_LOG = os.path.join(basedir, 'logs/slow-queries.log')
+
+    METRICS_PATH = os.path.join(FILE_CACHE_PATH, 'metrics')
+    METRICS_FLUSH_INTERVAL = 5
+
+    PROFILER_PATH = os.path.join(FILE_CACHE_PATH, 'profiles')
+    PROFILER_MAX_FILES = 50
+
+    TRACE_CAPTURE = bool(int(os.getenv('TRACE_CAPTURE', 0)))
+    TRACE_LOG = os.path.join(basedir, 'logs/traces.log')
+
+    # cost of new password hashes; older hashes are upgraded at login
+    PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:150000')
+    PASSWORD_SALT_LENGTH = 16
+    # per uwsgi worker process, each keeps a pool of this size
+    PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', min(os.cpu_count() or 1, 2)))
+
     SESSION_LIFETIME_MINUTES = int(os.getenv('SESSION_LIFETIME_MINUTES', 10))
 
+    SCHEDULER_EXECUTORS = {
+        'default': {'type': 'threadpool', 'max_workers': 10},
+        'exports': {'type': 'threadpool', 'max_workers': EXPORT_WORKERS},
+    }
+
     ALLOWED_EXTENSIONS = set(['jpg', 'jpeg', 'png'])
     UPLOAD_PATH = os.path.join(basedir, 'uploads')
     MAX_CONTENT_LENGTH = 17 * 1024 * 1024
@@ -67,6 +108,8 @@ class BaseConfig(object):
 
 class DevelopmentConfig(BaseConfig):
     FLASK_ENV = 'development'
+    # only read by the debug toolbar
+    SQLALCHEMY_RECORD_QUERIES = True
     SQLALCHEMY_DATABASE_URI = prefix + os.path.join(basedir, 'data-dev.db')
     REDIS_URL = "redis://localhost"
 
@@ -74,6 +117,11 @@ class DevelopmentConfig(BaseConfig):
 class TestingConfig(BaseConfig):
     TESTING = True
     WTF_CSRF_ENABLED = False
+    AUDIT_BUFFERED = False
+    SQL_SLOW_QUERY_LOG = None
+    METRICS_PATH = None
+    TRACE_LOG = None
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'  # in-memory database
 
 
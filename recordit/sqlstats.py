@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import random
+import time
+from collections import deque
+from logging.handlers import WatchedFileHandler
+from os import path
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from recordit.loggers import BackgroundHandler
+from recordit.metrics import metrics
+
+
+def shape(parameters):
+    """Types of the bound parameters, never their values."""
+    if isinstance(parameters, dict):
+        return dict((key, type(value).__name__) for key, value in parameters.items())
+    if isinstance(parameters, (list, tuple)):
+        return [type(value).__name__ for value in parameters]
+    return type(parameters).__name__
+
+
+class SQLStats(object):
+    """Per-request statement counts and DB time, plus a slow-query log.
+
+    A ``SQL_STATS_SAMPLE_RATE`` share of requests is instrumented. For
+    those, every statement is counted and timed, the totals are sent back
+    in a ``Server-Timing`` header and recorded by ``recordit.metrics``,
+    which adds them up over all workers, and statements slower than
+    ``SQL_SLOW_QUERY_THRESHOLD`` seconds are appended to
+    ``SQL_SLOW_QUERY_LOG`` as JSON lines, with the ``EXPLAIN`` plan when
+    ``SQL_SLOW_QUERY_EXPLAIN`` is on. Every worker appends to the same log,
+    which is rotated outside the app (see ``server/logrotate.conf``).
+    """
+
+    def __init__(self, app=None):
+        self.logger = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SQL_STATS_SAMPLE_RATE', 1.0)
+        app.config.setdefault('SQL_SLOW_QUERY_THRESHOLD', 0.2)
+        app.config.setdefault('SQL_SLOW_QUERY_EXPLAIN', False)
+        app.config.setdefault('SQL_SLOW_QUERY_LOG', None)
+
+        app.extensions['sqlstats'] = self
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+
+        if app.config['SQL_SLOW_QUERY_LOG']:
+            handler = WatchedFileHandler(app.config['SQL_SLOW_QUERY_LOG'], delay=True)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self.logger = logging.getLogger('recordit.slow_queries')
+            self.logger.propagate = False
+            self.logger.setLevel(logging.INFO)
+            self.logger.handlers = [BackgroundHandler(handler)]
+
+        if not event.contains(Engine, 'before_cursor_execute', before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+
+    def before_request(self):
+        if random.random() < current_app.config['SQL_STATS_SAMPLE_RATE']:
+            g.sql_stats = {'count': 0, 'time': 0.0}
+
+    def after_request(self, response):
+        stats = g.pop('sql_stats', None)
+        if stats is None:
+            return response
+
+        response.headers.add(
+            'Server-Timing', 'db;desc="%d statements";dur=%.1f'
+            % (stats['count'], stats['time'] * 1000))
+        return response
+
+    def endpoints(self):
+        """Sampled totals per endpoint over every worker, busiest DB first.
+
+        They are read from the ``recordit_db_*`` histograms of the metrics,
+        so ``max_count`` is the bound of the highest bucket reached, like
+        '<= 20', rather than an exact figure.
+        """
+        counters, histograms = metrics.collect()
+        totals = {}
+        for (name, labels), histogram in histograms.items():
+            if name not in ('recordit_db_statements', 'recordit_db_duration_seconds'):
+                continue
+            endpoint = dict(labels)['endpoint']
+            entry = totals.setdefault(
+                endpoint, {'requests': 0, 'count': 0, 'time': 0.0, 'max_count': None})
+            if name == 'recordit_db_duration_seconds':
+                entry['time'] += histogram['sum']
+                continue
+
+            entry['requests'] += histogram['count']
+            entry['count'] += histogram['sum']
+            reached = [bound for bound, count in zip(histogram['buckets'], histogram['counts'])
+                       if count]
+            if sum(histogram['counts']) < histogram['count']:
+                entry['max_count'] = '> %d' % histogram['buckets'][-1]
+            elif reached:
+                entry['max_count'] = '<= %d' % reached[-1]
+
+        return sorted(((endpoint, entry) for endpoint, entry in totals.items()
+                       if entry['requests']), key=lambda item: item[1]['time'], reverse=True)
+
+    def slow_query(self, connection, statement, parameters, executemany, elapsed):
+        if self.logger is None:
+            return
+
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'endpoint': request.endpoint,
+            'duration': round(elapsed, 4),
+            'statement': statement,
+            'parameters': shape(parameters[0] if executemany and parameters else parameters),
+            'executemany': len(parameters) if executemany else None,
+        }
+        if current_app.config['SQL_SLOW_QUERY_EXPLAIN'] and not executemany:
+            entry['plan'] = explain(connection, statement, parameters)
+
+        self.logger.info(json.dumps(entry, default=str))
+
+    def slow_queries(self, limit=100):
+        """The latest ``limit`` slow queries recorded by any worker, newest first."""
+        file = current_app.config['SQL_SLOW_QUERY_LOG']
+        if not file or not path.isfile(file):
+            return []
+
+        with open(file) as f:
+            lines = deque(f, maxlen=limit)
+        return [json.loads(line) for line in reversed(lines)]
+
+
+def explain(connection, statement, parameters):
+    if not statement.lstrip().upper().startswith('SELECT'):
+        return None
+
+    prefix = 'EXPLAIN QUERY PLAN ' if connection.dialect.name == 'sqlite' else 'EXPLAIN '
+    # the raw DBAPI cursor keeps the plan lookup out of the statistics
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute(prefix + statement, parameters)
+        return [list(row) for row in cursor.fetchall()]
+    except Exception:
+        return None
+    finally:
+        cursor.close()
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'sql_stats' in g:
+        conn.info.setdefault('query_start', []).append(time.time())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if not (has_request_context() and 'sql_stats' in g and conn.info.get('query_start')):
+        return
+
+    elapsed = time.time() - conn.info['query_start'].pop()
+    g.sql_stats['count'] += 1
+    g.sql_stats['time'] += elapsed
+
+    if elapsed >= current_app.config['SQL_SLOW_QUERY_THRESHOLD']:
+        sqlstats.slow_query(conn, statement, parameters, executemany, elapsed)
+
+
+sqlstats = SQLStats()
@@ -8,10 +8,31 @@ from recordit.extensions import scheduler
 
 @scheduler.task('interval', id='clear_cache', weeks=1)
 def clear_cache():
+    # only the loose files; exports, metrics and profiles live in
+    # subdirectories that manage their own files
     with scheduler.app.app_context():
-        for root, _, files in os.walk(current_app.config['FILE_CACHE_PATH']):
-            for file in files:
-                if file == '.gitkeep':
-                    continue
-                path = os.path.join(root, file)
+        cache_path = current_app.config['FILE_CACHE_PATH']
+        for file in os.listdir(cache_path):
+            path = os.path.join(cache_path, file)
+            if file == '.gitkeep' or not os.path.isfile(path):
+                continue
+            try:
                 os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+@scheduler.task('interval', id='evict_exports', hours=1)
+def evict_exports():
+    from recordit import exports
+
+    with scheduler.app.app_context():
+        exports.evict_exports()
+
+
+@scheduler.task('cron', id='archive_logs', hour=3)
+def archive_logs():
+    from recordit import audit
+
+    with scheduler.app.app_context():
+        audit.archive_logs()
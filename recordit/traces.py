@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import hmac
+import json
+import logging
+import time
+from logging.handlers import WatchedFileHandler
+
+from flask import g, request
+from flask_login import current_user
+
+from recordit.loggers import BackgroundHandler
+
+# query arguments that say nothing about the user and are kept as they are
+TRACE_ARGS = ('page', 'filter', 'format')
+
+
+class TraceRecorder(object):
+    """Record anonymized request traces for replay.
+
+    With ``TRACE_CAPTURE`` on, every request is appended to ``TRACE_LOG`` as
+    a JSON line with its time, method, endpoint, status and duration, up to
+    the last byte of the body, the role of the user and pseudonyms in place
+    of the user and of every id in the URL. All worker processes append to
+    the same file, which is rotated outside the app, by logrotate (see
+    ``server/logrotate.conf``); the handler reopens it once it was moved.
+    Pseudonyms are keyed on ``SECRET_KEY``, so they stay the same across
+    workers but cannot be traced back without it. Form data and other query
+    arguments than ``TRACE_ARGS`` are never kept. See
+    ``recordit.benchmarks.replay``.
+    """
+
+    def __init__(self, app=None):
+        self.logger = None
+        self.key = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('TRACE_CAPTURE', False)
+        app.config.setdefault('TRACE_LOG', None)
+
+        app.extensions['traces'] = self
+        if not (app.config['TRACE_CAPTURE'] and app.config['TRACE_LOG']):
+            return
+
+        self.key = hashlib.sha1(('trace' + app.config['SECRET_KEY']).encode('utf-8')).digest()
+        handler = WatchedFileHandler(app.config['TRACE_LOG'], delay=True)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self.logger = logging.getLogger('recordit.traces')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.logger.handlers = [BackgroundHandler(handler)]
+
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+
+    def pseudonym(self, kind, value):
+        digest = hmac.new(self.key, ('%s:%s' % (kind, value)).encode('utf-8'), hashlib.sha1)
+        return '%s:%s' % (kind, digest.hexdigest()[:12])
+
+    def before_request(self):
+        g.trace_start = time.time()
+
+    def after_request(self, response):
+        start = g.pop('trace_start', None)
+        if start is None or request.endpoint in (None, 'static'):
+            return response
+
+        user = None
+        role = None
+        if current_user.is_authenticated:
+            user = self.pseudonym('user', current_user.id)
+            role = current_user.role_name
+
+        entry = {
+            'time': round(start, 3),
+            'method': request.method,
+            'endpoint': request.endpoint,
+            'args': dict((key, self.pseudonym(key, value) if private(key) else value)
+                         for key, value in (request.view_args or {}).items()),
+            'query': dict((key, request.args[key]) for key in TRACE_ARGS if key in request.args),
+            'status': response.status_code,
+            'user': user,
+            'role': role,
+        }
+
+        def write():
+            # on close, so a streamed body counts as well
+            entry['duration'] = round(time.time() - start, 4)
+            self.logger.info(json.dumps(entry))
+
+        response.call_on_close(write)
+        return response
+
+
+def private(arg):
+    """Whether the URL argument ``arg`` names an object rather than a choice
+    such as a locale or an export kind."""
+    return arg.endswith('_id') or arg == 'file'
+
+
+traces = TraceRecorder()
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateColumn
+
+from recordit.extensions import db
+
+
+def missing_columns():
+    """Mapped columns of existing tables that the database lacks, as
+    ``(table, column)`` pairs."""
+    inspector = inspect(db.engine)
+    tables = set(inspector.get_table_names())
+
+    missing = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = set(column['name'] for column in inspector.get_columns(table.name))
+        missing.extend((table, column) for column in table.columns
+                       if column.name not in existing)
+    return missing
+
+
+def upgrade_schema(echo=None):
+    """Bring the tables of an existing database up to the models.
+
+    ``db.create_all`` only creates missing tables, so columns added to
+    existing ones since are added here with ``ALTER TABLE``; a new column
+    is either nullable or has a server default, so the old rows stay
+    valid. Missing tables and indexes are created afterwards. Returns the
+    added columns as ``'table.column'`` strings.
+    """
+    echo = echo or (lambda message: None)
+    added = []
+
+    with db.engine.begin() as connection:
+        for table, column in missing_columns():
+            ddl = CreateColumn(column).compile(dialect=connection.dialect)
+            echo('Adding %s.%s...' % (table.name, column.name))
+            connection.execute('ALTER TABLE %s ADD COLUMN %s' % (
+                connection.dialect.identifier_preparer.format_table(table), ddl))
+            added.append('%s.%s' % (table.name, column.name))
+
+    db.create_all()
+
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                echo('Creating index %s...' % index.name)
+                index.create(bind=db.engine)
+
+    return added
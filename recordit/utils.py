@@ -8,12 +8,11 @@ except ImportError:
 
 from os import path
 
-from flask import abort, current_app, flash, redirect, request, url_for
+from flask import current_app, flash, redirect, request, url_for
 from flask_babel import _
 from flask_login import current_user
 
-from recordit.extensions import db
-from recordit.models import Log
+from recordit.audit import Event, audit
 
 
 def is_safe_url(target):
@@ -40,42 +39,96 @@ def flash_errors(form):
                     name=name, error=error), 'dark')
 
 
-def log_user(content):
-    log = Log(
+def log_user(event, **params):
+    audit.write(
         user_id=current_user.id,
         ip=request.remote_addr,
-        content=content
+        event=event,
+        params=Event.dumps(params)
     )
 
-    db.session.add(log)
-    db.session.commit()
-
-
-def packitup(input_paths, output_path, diff=False, names=None, mode='w'):
-    from os import listdir, sep, walk
-    from zipfile import ZipFile
-
-    with ZipFile(output_path, mode) as z:
-        if diff:
-            if names:
-                for input_path, name in zip(input_paths, names):
-                    z.write(input_path, name)
-            else:
-                for input_path in input_paths:
-                    name = path.join(*input_path.split(sep)[-2:])
-                    z.write(input_path, name)
-        else:
-            if path.isdir(input_paths):
-                partent = input_paths.split(sep)[-1]
-                for file in listdir(input_paths):
-                    if file == '.gitkeep':
-                        continue
-                    z.write(path.join(input_paths, file), path.join(partent, file))
-            elif path.isfile(input_paths):
-                name = names if names is not None else path.split(input_paths)[-1]
-                z.write(input_paths, name)
-            else:
-                abort(404)
+
+# already compressed members are stored as they are instead of deflated again
+STORED_EXTENSIONS = set(['.jpg', '.jpeg', '.png', '.gif', '.zip', '.gz', '.xlsx', '.parquet'])
+
+
+class ZipBuffer(object):
+    """Write-only file object collecting what ``ZipFile`` writes between yields."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        del self.chunks[:]
+        return data
+
+
+def zipstream(members, chunk_size=64 * 1024):
+    """Yield a ZIP archive of ``members`` chunk by chunk.
+
+    ``members`` yields ``(name, data)`` pairs, where ``data`` is the bytes
+    of the member, a path on disk, which is read ``chunk_size`` bytes at a
+    time, or an iterable of bytes chunks produced on the fly. Nothing is
+    written to disk and at most one chunk is held in memory. Missing files
+    are skipped.
+    """
+    from time import localtime
+    from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile, ZipInfo
+
+    buffer = ZipBuffer()
+    with ZipFile(buffer, 'w', ZIP_DEFLATED) as z:
+        for name, data in members:
+            stored = path.splitext(name)[-1].lower() in STORED_EXTENSIONS
+            compress_type = ZIP_STORED if stored else ZIP_DEFLATED
+
+            if isinstance(data, bytes):
+                z.writestr(name, data, compress_type)
+            elif not isinstance(data, str):
+                info = ZipInfo(name, localtime()[:6])
+                info.compress_type = compress_type
+                with z.open(info, 'w', force_zip64=True) as dst:
+                    for chunk in data:
+                        dst.write(chunk)
+                        chunk = buffer.drain()
+                        if chunk:
+                            yield chunk
+            elif path.isfile(data):
+                info = ZipInfo.from_file(data, name)
+                info.compress_type = compress_type
+                with open(data, 'rb') as src, z.open(info, 'w') as dst:
+                    for chunk in iter(lambda: src.read(chunk_size), b''):
+                        dst.write(chunk)
+                        chunk = buffer.drain()
+                        if chunk:
+                            yield chunk
+
+            chunk = buffer.drain()
+            if chunk:
+                yield chunk
+
+    yield buffer.drain()
+
+
+def send_stream(chunks, filename, mimetype='application/zip'):
+    """Stream ``chunks`` to the client as the attachment ``filename``."""
+    from flask import Response, stream_with_context
+
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    response.headers['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    return response
+
+
+def send_zip(members, filename):
+    """Stream a ZIP archive of ``members`` as the attachment ``filename``."""
+    return send_stream(zipstream(members), filename)
 
 
 def safe_filename(filename):
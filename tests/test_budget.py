@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""Statement budgets of every page.
+
+Run with ``python -m pytest tests``. The app is built with ``TestingConfig``
+on an in-memory database, filled with fake data at two scales, and every
+route of the ``front``, ``auth``, ``user`` and ``admin`` blueprints is
+requested as the role that normally uses it. A case fails when it does not
+answer its expected status, when it runs more SQL statements than its
+budget, or more statements on the larger data set than on the smaller one,
+which is how an N+1 through a model property shows up. Routes added
+without a case or a reason to skip them fail as well.
+"""
+
+import re
+from urllib.parse import urlparse
+
+import pytest
+from flask import url_for
+
+# (endpoint, role, url arguments, statement budget); argument values naming
+# a key of the fixture ids are replaced by that id
+CASES = [
+    ('front.index', None, {}, 0),
+    ('front.about', None, {}, 4),
+    ('front.set_locale', None, {'locale': 'en_US'}, 0),
+    ('auth.login', None, {}, 0),
+    ('auth.re_authenticate', 'student', {}, 1),
+
+    ('user.index', 'student', {}, 5),
+    ('user.index', 'teacher', {}, 5),
+    ('user.index', 'admin', {}, 5),
+    ('user.review', 'student', {'report_id': 'report'}, 5),
+    ('user.settings', 'student', {}, 1),
+    ('user.edit_profile', 'student', {}, 1),
+    ('user.change_password', 'student', {}, 1),
+
+    ('admin.index', 'admin', {}, 10),
+    ('admin.index', 'teacher', {}, 10),
+    ('admin.manage_user', 'admin', {'filter': 'all'}, 6),
+    ('admin.edit_profile', 'admin', {'user_id': 'student'}, 4),
+    ('admin.change_password', 'admin', {'user_id': 'student'}, 4),
+    ('admin.register_student', 'admin', {}, 2),
+    ('admin.register_teacher', 'admin', {}, 2),
+    ('admin.register_administrator', 'admin', {}, 2),
+    ('admin.register_batch', 'admin', {}, 2),
+    ('admin.manage_course', 'admin', {}, 6),
+    ('admin.manage_course', 'teacher', {}, 6),
+    ('admin.add_course', 'admin', {}, 3),
+    ('admin.manage_report', 'admin', {'course_id': 'course'}, 7),
+    ('admin.manage_report', 'teacher', {'course_id': 'course'}, 7),
+    ('admin.download_report', 'admin', {'course_id': 'course'}, 10),
+    ('admin.add_report', 'admin', {'course_id': 'course'}, 4),
+    ('admin.add_report_batch', 'admin', {'course_id': 'course'}, 3),
+    ('admin.manage_record', 'admin', {'report_id': 'report'}, 7),
+    ('admin.manage_record', 'teacher', {'report_id': 'report'}, 7),
+    ('admin.download_record', 'admin', {'report_id': 'report'}, 10),
+    ('admin.user_log', 'admin', {}, 3),
+    ('admin.sql_stats', 'admin', {}, 1),
+    ('admin.profiles', 'admin', {}, 1),
+    ('admin.prometheus_metrics', 'admin', {}, 1),
+]
+
+# (endpoint, role) -> status of the cases that do not answer 200
+STATUS = {
+    ('front.set_locale', None): 302,
+    # the login of the client is fresh
+    ('auth.re_authenticate', 'student'): 302,
+    # only redirects to the profile page
+    ('user.settings', 'student'): 302,
+}
+
+# endpoint -> why it has no case
+SKIPPED = {
+    'auth.logout': 'ends the session of the client',
+    'admin.delete_user': 'changes the data set',
+    'admin.switch_course_state': 'changes the data set',
+    'admin.switch_report_state': 'changes the data set',
+    'admin.delete_report': 'changes the data set',
+    'admin.delete_record': 'changes the data set',
+    'admin.download_file': 'needs an uploaded file',
+    'admin.export': 'runs on the scheduler',
+    'admin.export_job': 'runs on the scheduler',
+    'admin.download_export': 'runs on the scheduler',
+    'admin.download_profile': 'needs a stored profile',
+    'admin.system_log': 'reads the system log file only',
+}
+
+BLUEPRINTS = ('front', 'auth', 'user', 'admin')
+
+SERVER_TIMING = re.compile(r'db;desc="(\d+) statements"')
+
+CSRF_TOKEN = re.compile(r'<input[^>]*name="csrf_token"[^>]*value="([^"]*)"')
+
+SMALL = 0.1
+LARGE = 1.0
+
+
+def forge_dataset(scale):
+    """Rebuild the database with fake data of ``scale``."""
+    from recordit.extensions import cache, db
+    from recordit.fakes import fake_admin, forge
+    from recordit.models import Role
+
+    db.drop_all()
+    db.create_all()
+    Role.init_role()
+    cache.clear()
+
+    fake_admin()
+    forge(scale)
+
+
+def fixture_ids():
+    """The objects the cases look at: the busiest report and its course,
+    that course's teacher and a student of its grade who did not present."""
+    from sqlalchemy import func
+
+    from recordit.extensions import db
+    from recordit.models import Course, RecordTable, Report, User, role_registry
+
+    report_id = db.session.query(RecordTable.report_id).group_by(
+        RecordTable.report_id).order_by(func.count(RecordTable.id).desc()).limit(1).scalar()
+    report = Report.query.get(report_id)
+    course = Course.query.get(report.course_id)
+    student = User.query.filter(
+        User.role_id == role_registry.id('Student'),
+        User.number.like(course.grade + '%'),
+        User.id != report.speaker_id).first()
+
+    return {
+        'report': report.id,
+        'course': course.id,
+        'teacher': course.teacher_id,
+        'student': student.id,
+    }
+
+
+def url(app, endpoint, **args):
+    with app.test_request_context():
+        return url_for(endpoint, **args)
+
+
+def get(client, url):
+    """GET ``url``, closing the response so a streamed body pops its contexts."""
+    response = client.get(url)
+    response.get_data()
+    response.close()
+    return response
+
+
+def login(app, number):
+    """A test client logged in as ``number``, or anonymous when it is None."""
+    client = app.test_client()
+    if number is None:
+        return client
+
+    login_url = url(app, 'auth.login')
+    match = CSRF_TOKEN.search(get(client, login_url).get_data(as_text=True))
+    response = client.post(login_url, data={
+        'username': number, 'password': app.config['ADMIN_PASSWORD'],
+        'csrf_token': match.group(1) if match else ''})
+    response.close()
+    assert response.status_code == 302, 'could not log in as %s' % number
+    assert urlparse(response.location).path == url(app, 'user.index'), \
+        'could not log in as %s' % number
+    return client
+
+
+def measure(app, scale):
+    """Status and statement count of every case on a data set of ``scale``.
+
+    Each request runs in an app context of its own, as in production; one
+    shared context would share ``g``, and with it the cached CSRF token,
+    between the clients.
+    """
+    from recordit.models import User
+
+    with app.app_context():
+        forge_dataset(scale)
+        ids = fixture_ids()
+        numbers = {
+            None: None,
+            'admin': app.config['ADMIN_NUMBER'],
+            'teacher': User.query.get(ids['teacher']).number,
+            'student': User.query.get(ids['student']).number,
+        }
+    clients = dict((role, login(app, number)) for role, number in numbers.items())
+
+    counts = {}
+    for endpoint, role, args, budget in CASES:
+        args = dict((key, ids.get(value, value)) for key, value in args.items())
+        path = url(app, endpoint, **args)
+
+        # the first request warms the per-process caches
+        get(clients[role], path)
+        response = get(clients[role], path)
+        match = SERVER_TIMING.search(response.headers.get('Server-Timing', ''))
+        counts[endpoint, role] = {
+            'status': response.status_code,
+            'statements': int(match.group(1)) if match else None,
+        }
+    return counts
+
+
+def uncovered(app):
+    covered = set(case[0] for case in CASES) | set(SKIPPED)
+    return sorted(set(
+        rule.endpoint for rule in app.url_map.iter_rules()
+        if rule.endpoint.split('.')[0] in BLUEPRINTS) - covered)
+
+
+@pytest.fixture(scope='module')
+def app():
+    from recordit import create_app
+
+    app = create_app('testing')
+    app.config['SQL_STATS_SAMPLE_RATE'] = 1.0
+    # the templates render the CSRF fields of their forms
+    app.config['WTF_CSRF_ENABLED'] = True
+    if not app.config.get('ADMIN_NUMBER'):
+        app.config['ADMIN_NUMBER'] = 'admin'
+    return app
+
+
+@pytest.fixture(scope='module')
+def counts(app):
+    return measure(app, SMALL), measure(app, LARGE)
+
+
+def test_every_route_has_a_budget(app):
+    assert uncovered(app) == []
+
+
+@pytest.mark.parametrize('endpoint, role, args, budget', CASES,
+                         ids=['%s-%s' % (case[0], case[1] or 'anonymous') for case in CASES])
+def test_budget(counts, endpoint, role, args, budget):
+    small, large = (scale[endpoint, role] for scale in counts)
+    status = STATUS.get((endpoint, role), 200)
+
+    for result in (small, large):
+        assert result['status'] == status
+        assert result['statements'] is not None, 'not measured'
+        assert result['statements'] <= budget
+    assert large['statements'] <= small['statements'], 'grows with data'